@@ -3,7 +3,12 @@
 import os
 import json
 import time
-import subprocess
+import heapq
+import pickle
+import datetime
+import random
+import tempfile
+import tracemalloc
 import argparse
 import base64
 
@@ -14,38 +19,108 @@ import resolv
 import sendmail
 import validation
 import icann_tlds
+import postfix_maps
 from log import this_log as log
 import misc
 
-RR_MX = 15
 
-
-def check_mx_match(user_mx, mx_rrs):
-    if ((user_mx is None) or (mx_rrs is None)
-            or (mx_rrs.get("Status", 99) != 0) or ("Answer" not in mx_rrs)
-            or (not isinstance(mx_rrs["Answer"], list))
-            or (len(mx_rrs["Answer"]) != 1)):
-        return False
-
-    mx = mx_rrs["Answer"][0]
-    if mx.get("type", 0) != RR_MX or mx.get("data", None) is None:
+def check_mx_match(user_mx, mx_reply):
+    if ((user_mx is None) or (mx_reply is None) or (mx_reply.rcode != 0)
+            or (len(mx_reply.mx) != 1)):
         return False
 
-    mx_rr = mx["data"].split()[1].rstrip(".").lower()
+    __, mx_rr = mx_reply.mx[0]
     chk_rr = (user_mx + "." + policy.get("email_domain")).rstrip(".").lower()
 
     return chk_rr == mx_rr
 
 
-def user_to_json(user_data):
+def user_to_json(this_user):
     return json.dumps({
-        "domains": user_data["domains"],
-        "identities": user_data["identities"]
+        "domains": this_user.domains(),
+        "identities": this_user.identities
     })
 
 
-def user_has_changed(old_user, this_user):
-    return user_to_json(old_user) != user_to_json(this_user)
+def user_has_changed(old_json, this_user):
+    return old_json != user_to_json(this_user)
+
+
+def login_time(when_dt):
+    try:
+        return datetime.datetime.fromisoformat(when_dt).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+class UserRecord:
+    """ just what the DOMS runner needs of a user, anything else is loaded when it's wanted.
+        Domains are a tuple of names & a bitmap of which are active """
+
+    __slots__ = ("user", "uid", "mx", "password", "domain_names",
+                 "active_bits", "identities", "domain_state", "last_login",
+                 "events")
+
+    def __init__(self, js):
+        self.user = js["user"]
+        self.uid = js.get("uid", 0)
+        self.mx = js.get("mx", None)
+        self.password = js.get("password", None)
+        doms = js.get("domains", {})
+        self.domain_names = tuple(doms)
+        self.active_bits = sum(1 << idx
+                               for idx, dom in enumerate(self.domain_names)
+                               if doms[dom])
+        self.identities = js.get("identities", [])
+        self.domain_state = js.get("domain_state", None) or None
+        self.last_login = login_time(js.get("last_login_dt", None))
+        self.events = None
+
+    def has_domain(self, domain):
+        return domain in self.domain_names
+
+    def is_active(self, domain):
+        if domain not in self.domain_names:
+            return False
+        return (self.active_bits >> self.domain_names.index(domain)) & 1 == 1
+
+    def set_active(self, domain, active):
+        """ set the state of {domain}, adding it if it's new """
+        if domain not in self.domain_names:
+            self.domain_names += (domain, )
+        bit = 1 << self.domain_names.index(domain)
+        self.active_bits = (self.active_bits
+                            | bit) if active else (self.active_bits & ~bit)
+
+    def remove_domain(self, domain):
+        doms = self.domains()
+        doms.pop(domain, None)
+        self.domain_names = tuple(doms)
+        self.active_bits = sum(1 << idx
+                               for idx, dom in enumerate(self.domain_names)
+                               if doms[dom])
+        if self.domain_state is not None:
+            self.domain_state.pop(domain, None)
+
+    def domains(self):
+        """ as they are saved, {domain: is_active} """
+        return {
+            dom: (self.active_bits >> idx) & 1 == 1
+            for idx, dom in enumerate(self.domain_names)
+        }
+
+    def active_domains(self):
+        return [
+            dom for idx, dom in enumerate(self.domain_names)
+            if (self.active_bits >> idx) & 1
+        ]
+
+    def full(self):
+        """ the whole user from the store, e.g. for the email templates """
+        ok, js = uconfig.load(self.user)
+        if not ok:
+            return {"user": self.user, "mx": self.mx}
+        return js
 
 
 def clean_up_emails(emails):
@@ -58,8 +133,201 @@ def clean_up_emails(emails):
     return new_list
 
 
+def snapshot_header():
+    """ a snapshot is only any use to the same store it was made from """
+    return {
+        "version": SNAPSHOT_VERSION,
+        "user_store": policy.get("user_store", "files"),
+        "user_dir": policy.USER_DIR
+    }
+
+
+def load_snapshot():
+    """ users as {user: (stamp, record)} from the last start up, or empty if there is no usable snapshot """
+    try:
+        with open(policy.DOMS_SNAPSHOT, "rb") as fd:
+            header, users = pickle.load(fd)
+    except (OSError, EOFError, ValueError, AttributeError, ImportError,
+            pickle.UnpicklingError):
+        return {}
+    return users if header == snapshot_header() else {}
+
+
+def save_snapshot(users):
+    """ it holds password hashes, so stays readable by us only """
+    try:
+        with tempfile.NamedTemporaryFile("wb",
+                                         dir=os.path.dirname(
+                                             policy.DOMS_SNAPSHOT),
+                                         delete=False) as fd:
+            pickle.dump((snapshot_header(), users), fd,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(fd.name, policy.DOMS_SNAPSHOT)
+    except OSError as err:
+        log.log(f"ERROR: saving DOMS snapshot: {err}")
+
+
 def active_uid(this_user):
-    return this_user.get("uid", 0) > 100
+    return this_user.uid > 100
+
+
+def domains_to_check(this_user):
+    return [
+        dom for idx, dom in enumerate(this_user.domain_names)
+        if not (this_user.active_bits >> idx) & 1
+    ]
+
+
+NEVER_COALESCE = {"request_password_reset", "test"}
+COALESCE_BY_VERB = {
+    "remake_unix_files", "remake_mail_files", "password_changed",
+    "start_up_new_files", "user_age_check"
+}
+
+
+def coalesce_key(cmd_data):
+    """ commands with the same key in one batch only need running once """
+    verb = cmd_data["verb"]
+    if verb in NEVER_COALESCE:
+        return None
+    if verb in COALESCE_BY_VERB:
+        return verb
+    data = cmd_data.get("data", None)
+    if verb == "identity_changed" and isinstance(data, dict):
+        return verb + ":" + str(data.get("user", None))
+    return verb + ":" + json.dumps(data, sort_keys=True)
+
+
+def coalesce_cmds(cmds):
+    """ indexes of the {cmds} to run, earlier duplicates are dropped, so the newest of each is run, in order """
+    last_seen = {}
+    for idx, cmd_data in enumerate(cmds):
+        if (key := coalesce_key(cmd_data)) is not None:
+            last_seen[key] = idx
+    return [
+        idx for idx, cmd_data in enumerate(cmds)
+        if (key := coalesce_key(cmd_data)) is None or last_seen[key] == idx
+    ]
+
+
+def remove_cmd_file(file):
+    if file is not None and os.path.isfile(file):
+        os.remove(file)
+
+
+MX_BACKOFF = 0.25
+DOMAIN_HISTORY_SIZE = 10
+SNAPSHOT_VERSION = 2
+
+
+def domain_should_change(this_user, domain, dom_active, was_active):
+    """ hysteresis, only change after {mx_flap_agree} results in a row that agree
+        & when the domain has been in its current state at least {mx_flap_dwell} secs """
+    if this_user.domain_state is None:
+        this_user.domain_state = {}
+    state = this_user.domain_state.setdefault(domain, {})
+    if dom_active == was_active:
+        state.pop("pending", None)
+        state.pop("agree", None)
+        return False
+
+    if state.get("pending", None) != dom_active:
+        state["pending"] = dom_active
+        state["agree"] = 0
+    state["agree"] += 1
+
+    if state["agree"] < policy.get("mx_flap_agree", 2):
+        return False
+    if state.get("changed_dt",
+                 "") > misc.now(-1 * policy.get("mx_flap_dwell", 300)):
+        return False
+
+    del state["pending"]
+    del state["agree"]
+    state["changed_dt"] = misc.now()
+    history = state.setdefault("history", [])
+    history.append({"when_dt": state["changed_dt"], "active": dom_active})
+    del history[:-DOMAIN_HISTORY_SIZE]
+    return True
+
+
+def check_interval(ttl, stable_for):
+    """ no point asking again before the TTL is up, after that back off the longer nothing changes """
+    return min(
+        policy.get("mx_check_max_interval", 86400),
+        max(policy.get("mx_check_min_interval", 60), ttl,
+            stable_for * MX_BACKOFF))
+
+
+class MxSchedule:
+    """ heap of (next_check_time, user, domain), so domains are checked about as often as they change """
+
+    def __init__(self):
+        self.heap = []
+        self.due = {}
+        self.stable_since = {}
+        self.ladder = {}
+
+    def add(self, user, domain, when, stable_since=None, ladder=None):
+        """ (re)schedule {user}:{domain}, any earlier entry for it is ignored when popped
+            {ladder} is a list of quick re-check delays to use until the domain changes """
+        key = (user, domain)
+        if ladder is not None:
+            self.ladder[key] = list(ladder)
+        if stable_since is not None or key not in self.stable_since:
+            self.stable_since[
+                key] = when if stable_since is None else stable_since
+        self.due[key] = when
+        heapq.heappush(self.heap, (when, user, domain))
+
+    def checked(self, user, domain, ttl, now, changed=False, pending=False):
+        """ after a check, soon again if it just changed, else backing off """
+        key = (user, domain)
+        if changed:
+            self.ladder.pop(key, None)
+        if changed or pending or key not in self.stable_since:
+            self.stable_since[key] = now
+        if self.ladder.get(key, None):
+            self.add(user, domain, now + self.ladder[key].pop(0))
+            return
+        self.ladder.pop(key, None)
+        self.add(user, domain,
+                 now + check_interval(ttl, now - self.stable_since[key]))
+
+    def in_ladder(self, user, domain):
+        return (user, domain) in self.ladder
+
+    def remove(self, user):
+        for key in [key for key in self.due if key[0] == user]:
+            del self.due[key]
+            self.stable_since.pop(key, None)
+            self.ladder.pop(key, None)
+
+    def pop_due(self, now, limit):
+        """ up to {limit} (user, domain) that are due by {now} """
+        ret = []
+        while self.heap and self.heap[0][0] <= now and len(ret) < limit:
+            when, user, domain = heapq.heappop(self.heap)
+            if self.due.get((user, domain), None) == when:
+                del self.due[(user, domain)]
+                ret.append((user, domain))
+        return ret
+
+    def wait_time(self):
+        """ seconds until the next check is due, None if there's nothing scheduled """
+        while self.heap and self.due.get(
+            (self.heap[0][1], self.heap[0][2]), None) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    def info(self):
+        return {
+            "scheduled": len(self.due),
+            "heap": len(self.heap),
+            "ladder": len(self.ladder)
+        }
 
 
 class UserData:
@@ -70,17 +338,27 @@ class UserData:
         self.need_remake_unix_files = False
         self.resolver = None
         self.active_users = {}
+        self.mail_maps = None
+        self.schedule = MxSchedule()
+        self.batch_stats = {
+            "batches": 0,
+            "commands": 0,
+            "coalesced": 0,
+            "remakes": 0,
+            "remakes_saved": 0
+        }
 
     def startup(self):
-        self.resolver = resolv.Resolver()
+        self.resolver = resolv.get_shared_resolver(
+            policy.get("dns_cache_size", 10000), policy.DNS_CACHE_FILE)
         self.load_user_details()
 
     def load_user_details(self):
         self.load_users()
         self.active_users = {
             user: True
-            for user in self.all_users
-            if misc.is_user_active(self.all_users[user])
+            for user, this_user in self.all_users.items()
+            if this_user.is_active(user)
         }
 
         for user in self.active_users:
@@ -89,16 +367,30 @@ class UserData:
                 self.assign_uid(this_user)
 
     def finish_start_uo(self):
-        self.run_mx_check(None)
+        self.schedule_all_domains()
         self.check_remake_files()
 
+    def schedule_all_domains(self):
+        """ inactive domains are checked straight away, active ones spread over the max interval """
+        now = time.time()
+        spread = policy.get("mx_check_max_interval", 86400)
+        for user, this_user in self.all_users.items():
+            for domain, is_active in this_user.domains().items():
+                if is_active:
+                    self.schedule.add(user,
+                                      domain,
+                                      now + random.uniform(0, spread),
+                                      stable_since=now - spread)
+                else:
+                    self.schedule.add(user, domain, now)
+
     def assign_uid(self, this_user):
         if active_uid(this_user):
             return
-        user = this_user["user"]
+        user = this_user.user
         this_uid = self.find_free_uid()
         self.active_users[user] = True
-        this_user["uid"] = this_uid
+        this_user.uid = this_uid
         uconfig.update(user, {"uid": this_uid})
         executor.create_command("doms_runner_user_add", "root", {
             "verb": "make_home_dir",
@@ -110,19 +402,20 @@ class UserData:
         self.need_remake_unix_files = True
 
     def load_users(self):
-        all_user_files = subprocess.run([
-            "/bin/busybox", "find", policy.USER_DIR, "-type", "f", "-name",
-            "*.json"
-        ],
-                                        capture_output=True)
-        self.all_users = {}
-        manager_account = policy.get("manager_account")
-        for file in all_user_files.stdout.decode('utf-8').strip().split():
-            user = file.split("/")[-1][:-5]
-            if user != manager_account:
-                ok, reply = uconfig.load(user, with_events=False)
-                if ok:
-                    self.all_users[user] = reply
+        """ users whose file hasn't changed since the snapshot was made are taken from it """
+        use_snapshot = policy.get("user_store", "files") == "files"
+        known = load_snapshot() if use_snapshot else None
+        users = uconfig.load_all(skip=policy.get("manager_account"),
+                                 known=known)
+        for user, (stamp, entry) in users.items():
+            if isinstance(entry, dict):
+                users[user] = (stamp, UserRecord(entry))
+        self.all_users = {user: entry for user, (__, entry) in users.items()}
+
+        if use_snapshot and (len(users) != len(known)
+                             or any(entry is not known.get(user, None)
+                                    for user, entry in users.items())):
+            save_snapshot(users)
 
     def remake_unix_files(self, data):
         base_data = {}
@@ -142,7 +435,7 @@ class UserData:
             for user in self.active_users:
                 this_user = self.all_users[user]
                 lines.append(
-                    f"{user}:x:{this_user['uid']}:100::{os.path.join(policy.HOME_DIR, user)}:/sbin/nologin"
+                    f"{user}:x:{this_user.uid}:100::{os.path.join(policy.HOME_DIR, user)}:/sbin/nologin"
                 )
             fd.write("\n".join(lines) + "\n")
 
@@ -154,8 +447,7 @@ class UserData:
                 )
             for user in self.active_users:
                 this_user = self.all_users[user]
-                lines.append(
-                    f"{user}:{this_user['password']}:20367:0:99999:7:::")
+                lines.append(f"{user}:{this_user.password}:20367:0:99999:7:::")
             fd.write("\n".join(lines) + "\n")
 
         with open("/run/group.tmp", "w+") as fd:
@@ -174,7 +466,7 @@ class UserData:
 
     def find_free_uid(self):
         taken_uids = {
-            self.all_users[user]["uid"]: True
+            self.all_users[user].uid: True
             for user in self.active_users if active_uid(self.all_users[user])
         }
         for x in range(1000, 30000):
@@ -187,10 +479,9 @@ class UserData:
             del self.all_users[user]
         if user in self.active_users:
             del self.active_users[user]
+        self.schedule.remove(user)
 
-        file = uconfig.user_file_name(user)
-        if os.path.isfile(file):
-            os.remove(file)
+        uconfig.remove(user)
 
         executor.create_command("doms_delete_user", "root", {
             "verb": "remove_home_dir",
@@ -200,34 +491,84 @@ class UserData:
         })
         self.need_remake_mail_files = self.need_remake_unix_files = True
 
+    def check_due_domains(self):
+        """ check one slice of the domains that are due, return True if there were any """
+        due = self.schedule.pop_due(time.time(),
+                                    policy.get("sweep_slice_size", 100))
+        laddered, others = [], []
+        for user, dom in due:
+            if self.schedule.in_ladder(user, dom):
+                laddered.append((user, dom))
+            else:
+                others.append((user, dom))
+        # split before either check, a check can take a domain off the ladder
+        if laddered:
+            self.check_domains(laddered, use_cache=False)
+        if others:
+            self.check_domains(others)
+        return len(due) > 0
+
+    def recheck_soon(self, user, check_now=False):
+        """ check {user}'s inactive domains now, then on the retry ladder till they change
+            with {check_now} the first check is done here & can use the cache, e.g. warmed by registration """
+        if user not in self.all_users:
+            return False
+        now = time.time()
+        domains = domains_to_check(self.all_users[user])
+        for domain in domains:
+            self.schedule.add(user,
+                              domain,
+                              now,
+                              ladder=policy.get("mx_check_retry_ladder", []))
+        if check_now:
+            self.check_domains([(user, domain) for domain in domains])
+        return True
+
+    def recheck_user(self, data):
+        if data is None or (user := data.get("user", None)) is None:
+            return False
+        return self.recheck_soon(user)
+
+    def finish_due_checks(self):
+        while self.check_due_domains():
+            pass
+        self.check_remake_files()
+
     def user_age_check(self, data):
         log.debug("User age check")
+        self.expire_old_users()
+        return True
 
-        for user in self.all_users:
-            self.check_one_user(self.all_users[user], check_all_domains=True)
-
-        never_active_old = misc.now(
-            -86400 * policy.get("never_active_account_expire", 7))
-        was_active_old = misc.now(-86400 *
-                                  policy.get("was_active_account_expire", 30))
+    def expire_old_users(self):
+        never_active_old = time.time() - 86400 * policy.get(
+            "never_active_account_expire", 7)
+        was_active_old = time.time() - 86400 * policy.get(
+            "was_active_account_expire", 30)
 
         for user in [u for u in self.all_users if u not in self.active_users]:
             this_user = self.all_users[user]
             if active_uid(this_user):
-                if this_user["last_login_dt"] < was_active_old:
+                if this_user.last_login < was_active_old:
                     self.delete_user(user)
             else:
-                if this_user["last_login_dt"] < never_active_old:
+                if this_user.last_login < never_active_old:
                     self.delete_user(user)
 
-        return True
-
     def run_mx_check(self, data=None):
-        if data is not None:
-            self.check_one_user(data)
-        else:
-            for user in self.all_users:
-                self.check_one_user(self.all_users[user])
+        """ {data} is a UserRecord, a command's {"user": name}, or None for every user """
+        if data is None:
+            now = time.time()
+            for user, this_user in self.all_users.items():
+                for domain in domains_to_check(this_user):
+                    self.schedule.add(user, domain, now)
+            return True
+
+        this_user = data
+        if isinstance(data, dict):
+            this_user = self.all_users.get(data.get("user", None))
+        if this_user is None:
+            return False
+        self.check_one_user(this_user, use_cache=False)
         return True
 
     def remake_mail_files_true(self, data):
@@ -238,67 +579,75 @@ class UserData:
         self.need_remake_unix_files = True
         return True
 
-    def remake_mail_files(self, data):
+    def make_mail_maps(self):
+        """ the postfix tables as {map: {key: value}} """
         email_domain = policy.get("email_domain").rstrip(".").lower()
         icann_smtp_relay = policy.get("icann_smtp_relay", None)
 
-        pfx = os.path.join(policy.BASE, "postfix", "data", "transport")
-        with open(pfx + ".tmp", "w") as fd:
-            fd.write(f"{email_domain} local: $myhostname\n")
-            for user in self.active_users:
-                doms = self.all_users[user]["domains"]
-                for dom in [d for d in doms if doms[d]]:
-                    fd.write(f"{dom} local: $myhostname\n")
-            if icann_smtp_relay is not None:
-                icann_smtp_relay = icann_smtp_relay.rstrip(".").lower()
-                for tld in icann_tlds.ICANN_TLDS:
-                    fd.write(f".{tld}:     smtp: [{icann_smtp_relay}]\n")
-
-        pfx = os.path.join(policy.BASE, "postfix", "data", "local")
-        with open(pfx + ".tmp", "w") as fd:
-            fd.write(f"{email_domain} OK\n")
-            for user in self.active_users:
-                doms = self.all_users[user]["domains"]
-                for dom in [d for d in doms if doms[d]]:
-                    fd.write(f"{dom} OK\n")
-
-        pfx = os.path.join(policy.BASE, "postfix", "data", "virtual")
-        with open(pfx + ".tmp", "w") as fd:
-            fd.write(f"manager@{email_domain} manager\n")
-            fd.write(f"root@{email_domain} manager\n")
-            fd.write(f"postmaster@{email_domain} manager\n")
-            fd.write(f"postfix@{email_domain} manager\n")
-            for user in self.active_users:
-                user_data = self.all_users[user]
-                doms = user_data["domains"]
-                for dom in [d for d in doms if doms[d]]:
-                    fd.write(f"{dom}@{email_domain} {user}\n")
-                for email in [
-                        e for e in user_data["identities"]
-                        if misc.is_email_active(user_data, e)
-                ]:
-                    fd.write(f"{email} {user}\n")
-
-        with open(policy.DOMAINS_FILE + ".tmp", "w") as fd:
-            json.dump(
-                {
-                    dom: True
-                    for user in Users.active_users
-                    for dom in Users.all_users[user].get("domains", {})
-                    if Users.all_users[user]["domains"][dom]
-                }, fd)
-        os.replace(policy.DOMAINS_FILE + ".tmp", policy.DOMAINS_FILE)
-
-        for file in ["transport", "local", "virtual"]:
-            pfx = os.path.join(policy.BASE, "postfix", "data", file)
-            os.replace(pfx + ".tmp", pfx + ".new")
+        transport = {email_domain: "local: $myhostname"}
+        local = {email_domain: "OK"}
+        virtual = {
+            f"{name}@{email_domain}": "manager"
+            for name in ["manager", "root", "postmaster", "postfix"]
+        }
+        for user in self.active_users:
+            this_user = self.all_users[user]
+            for dom in this_user.active_domains():
+                transport[dom] = "local: $myhostname"
+                local[dom] = "OK"
+                virtual[f"{dom}@{email_domain}"] = user
+            for email in [
+                    e for e in this_user.identities if this_user.is_active(
+                        e.rstrip(".").lower().split("@")[1])
+            ]:
+                virtual[email] = user
+
+        if icann_smtp_relay is not None:
+            icann_smtp_relay = icann_smtp_relay.rstrip(".").lower()
+            for tld in icann_tlds.ICANN_TLDS:
+                transport[f".{tld}:"] = f"smtp: [{icann_smtp_relay}]"
+
+        return {"transport": transport, "local": local, "virtual": virtual}
 
+    def remake_mail_files(self, data):
+        """ whole tables the first time, after that only what changed since the last time, as a delta """
+        mail_maps = self.make_mail_maps()
+        if self.mail_maps is None:
+            postfix_maps.remove_deltas()
+            for file in postfix_maps.MAPS:
+                pfx = postfix_maps.map_file(file)
+                postfix_maps.write_map(pfx + ".tmp", mail_maps[file])
+                os.replace(pfx + ".tmp", pfx + ".new")
+            local_changed = True
+        else:
+            deltas = {}
+            for file in postfix_maps.MAPS:
+                delta = postfix_maps.diff_map(self.mail_maps[file],
+                                              mail_maps[file])
+                if delta["add"] or delta["remove"]:
+                    deltas[file] = delta
+            if deltas:
+                postfix_maps.save_delta(deltas)
+            local_changed = "local" in deltas
+
+        if local_changed:
+            with open(policy.DOMAINS_FILE + ".tmp", "w") as fd:
+                json.dump(
+                    {
+                        dom: True
+                        for user in self.active_users
+                        for dom in self.all_users[user].active_domains()
+                    }, fd)
+            os.replace(policy.DOMAINS_FILE + ".tmp", policy.DOMAINS_FILE)
+
+        self.mail_maps = mail_maps
         return True
 
     def check_remake_files(self):
         log.debug(
             f"need_remake_mail_files: {self.need_remake_mail_files}, need_remake_unix_files: {self.need_remake_unix_files}"
         )
+        did_remake = self.need_remake_mail_files or self.need_remake_unix_files
 
         data = {"verb": "install_system_files"}
 
@@ -314,41 +663,74 @@ class UserData:
             executor.create_command("doms_check_remake_files", "root", data)
 
         self.need_remake_unix_files = self.need_remake_mail_files = False
-
-    def check_one_user(self, this_user, check_all_domains=False):
-        user = this_user["user"]
-        save_this_user = False
-        this_user["events"] = []
-        if (doms := this_user.get("domains", None)) is None:
-            return
-
-        for dom in [d for d in doms if not doms[d] or check_all_domains]:
-            if self.check_one_domain(this_user, dom):
-                save_this_user = True
-
-        if save_this_user:
-            log.debug(f"saving user '{user}'")
-            ok, reply = uconfig.update(
-                user, {
-                    "last_login_dt": misc.now(),
-                    "domains": this_user["domains"],
-                    "events": this_user["events"]
-                })
-            if ok:
-                this_user = reply
-
-    def check_one_domain(self, this_user, domain):
-        user = this_user["user"]
-        was_active = this_user["domains"].get(domain, False)
-        dom_active = check_mx_match(this_user.get("mx", None),
-                                    self.resolver.resolv(domain, "mx"))
+        return did_remake
+
+    def check_one_user(self, this_user, use_cache=True):
+        self.check_domains([(this_user.user, domain)
+                            for domain in domains_to_check(this_user)],
+                           use_cache=use_cache)
+
+    def check_domains(self, to_check, use_cache=True):
+        """ check (user, domain) pairs in one batch of queries, save the users that changed & reschedule them all """
+        to_check = [(user, domain) for user, domain in to_check
+                    if user in self.all_users
+                    and self.all_users[user].has_domain(domain)]
+        mx_replies = self.resolver.resolv_many([dom for __, dom in to_check],
+                                               "mx",
+                                               mx_only=True,
+                                               use_cache=use_cache)
+        now = time.time()
+        seen_users = {}
+        for user, domain in to_check:
+            this_user = self.all_users[user]
+            if user not in seen_users:
+                this_user.events = []
+                seen_users[user] = [
+                    False, json.dumps(this_user.domain_state or {})
+                ]
+            changed = self.check_one_domain(this_user, domain, use_cache,
+                                            mx_replies)
+            seen_users[user][0] = seen_users[user][0] or changed
+            pending = "pending" in this_user.domain_state.get(domain, {})
+            mx_reply = mx_replies.get(domain, None)
+            self.schedule.checked(user, domain,
+                                  0 if mx_reply is None else mx_reply.ttl, now,
+                                  changed, pending)
+
+        for user, (changed, old_state) in seen_users.items():
+            this_user = self.all_users[user]
+            if changed:
+                log.debug(f"saving user '{user}'")
+                uconfig.update(
+                    user, {
+                        "last_login_dt": misc.now(),
+                        "domains": this_user.domains(),
+                        "domain_state": this_user.domain_state,
+                        "events": this_user.events
+                    })
+            elif json.dumps(this_user.domain_state) != old_state:
+                uconfig.update(user, {"domain_state": this_user.domain_state})
+            this_user.events = None
+
+    def check_one_domain(self,
+                         this_user,
+                         domain,
+                         use_cache=True,
+                         mx_replies=None):
+        user = this_user.user
+        was_active = this_user.is_active(domain)
+        if mx_replies is not None and domain in mx_replies:
+            mx_reply = mx_replies[domain]
+        else:
+            mx_reply = self.resolver.resolv_mx(domain, use_cache=use_cache)
+        dom_active = check_mx_match(this_user.mx, mx_reply)
 
         log.debug(
             f"check_one_domain {user}:{domain} = {dom_active} (was {was_active})"
         )
 
-        if dom_active == was_active:
-            return False  # domain status is unchanged
+        if not domain_should_change(this_user, domain, dom_active, was_active):
+            return False  # domain status is unchanged, or not settled yet
 
         self.need_remake_mail_files = True
 
@@ -361,16 +743,19 @@ class UserData:
                     self.users_just_activated[user] = False
                 else:
                     self.assign_uid(this_user)
-                    log.debug(f"newly activated user {this_user}")
+                    log.debug(f"newly activated user {user}")
                     self.users_just_activated[user] = True
                 self.active_users[user] = True
             self.need_remake_unix_files = True
         else:
             log.debug(f"newly activated domain {domain}")
-            sendmail.post("new_domain", {"user": this_user, "domain": domain})
+            sendmail.post("new_domain", {
+                "user": this_user.full(),
+                "domain": domain
+            })
 
-        this_user["domains"][domain] = dom_active
-        this_user["events"].append({
+        this_user.set_active(domain, dom_active)
+        this_user.events.append({
             "desc":
             f"Domain '{domain}' is now {'active' if dom_active else 'inactive'}"
         })
@@ -380,7 +765,7 @@ class UserData:
     def email_users_welcome(self, data):
         for user, is_new in self.users_just_activated.items():
             email_type = "welcome" if is_new else "reactivated"
-            sendmail.post(email_type, {"user": self.all_users[user]})
+            sendmail.post(email_type, {"user": self.all_users[user].full()})
 
         self.users_just_activated = {}
         return True
@@ -404,38 +789,36 @@ class UserData:
         log.debug(f"USER:{user} EMAILS:{emails}")
 
         this_user = self.all_users[user]
-        old_user = this_user.copy()
+        old_json = user_to_json(this_user)
 
         email_domain = policy.get("email_domain").rstrip(".").lower()
 
-        this_user["identities"] = [user + "@" + dom for user, dom in emails]
         email_doms = [dom for __, dom in emails if dom != email_domain]
 
-        for dom in list(this_user["domains"]):
+        for dom in this_user.domain_names:
             if dom not in email_doms and dom != user:
-                del this_user["domains"][dom]
+                this_user.remove_domain(dom)
 
         for dom in email_doms:
-            if dom not in this_user["domains"]:
-                this_user["domains"][dom] = False
+            if not this_user.has_domain(dom):
+                this_user.set_active(dom, False)
 
-        this_user["identities"].sort()
-        if not user_has_changed(old_user, this_user):
+        this_user.identities = sorted(user + "@" + dom for user, dom in emails)
+        if not user_has_changed(old_json, this_user):
             log.debug("User hasn't changed")
             return True
 
         self.need_remake_mail_files = True
 
-        ok, reply = uconfig.update(
-            this_user["user"], {
+        uconfig.update(
+            user, {
                 "events": {
                     "desc": "Email Identities updated"
                 },
-                "identities": this_user["identities"],
-                "domains": this_user["domains"]
+                "identities": this_user.identities,
+                "domains": this_user.domains(),
+                "domain_state": this_user.domain_state or {}
             })
-        if ok:
-            this_user = reply
 
         self.run_mx_check(this_user)
         return True
@@ -447,8 +830,8 @@ class UserData:
         if not ok or this_user is None:
             return False
         this_user["user"] = user
-        self.all_users[user] = this_user
-        return True
+        self.all_users[user] = UserRecord(this_user)
+        return self.recheck_soon(user, check_now=True)
 
     def start_up_new_files(self, data):
         self.remake_unix_files(None)
@@ -464,6 +847,54 @@ class UserData:
             log.log(f"ERROR: cmd '{verb}' failed")
             return False
 
+    def dispatch_batch(self, cmds, files=None):
+        """ run all pending commands, then remake the system files once.
+            Each of {files}, one per command, is removed once its command has run or been dropped,
+            a command that raises is logged & dropped, so it can't stop the rest """
+        if files is None:
+            files = [None] * len(cmds)
+        to_run = coalesce_cmds(cmds)
+        for idx in set(range(len(cmds))) - set(to_run):
+            remove_cmd_file(files[idx])
+
+        need_mail = need_unix = False
+        wanted_remake = 0
+        all_ok = True
+        for idx in to_run:
+            verb = cmds[idx]["verb"]
+            log.debug(f"Running cmd: '{verb}'")
+            self.need_remake_mail_files = self.need_remake_unix_files = False
+            try:
+                ok = DOMS_CMDS[verb](cmds[idx].get("data", None))
+            except Exception as err:
+                log.log(f"ERROR: cmd '{verb}' raised {err}")
+                ok = False
+            remove_cmd_file(files[idx])
+            if not ok:
+                log.log(f"ERROR: cmd '{verb}' failed")
+                all_ok = False
+            if self.need_remake_mail_files or self.need_remake_unix_files:
+                wanted_remake += 1
+            need_mail = need_mail or self.need_remake_mail_files
+            need_unix = need_unix or self.need_remake_unix_files
+
+        self.need_remake_mail_files = need_mail
+        self.need_remake_unix_files = need_unix
+        remakes = 1 if self.check_remake_files() else 0
+
+        stats = self.batch_stats
+        stats["batches"] += 1
+        stats["commands"] += len(cmds)
+        stats["coalesced"] += len(cmds) - len(to_run)
+        stats["remakes"] += remakes
+        stats["remakes_saved"] += wanted_remake - remakes
+        if len(cmds) > 1:
+            log.log(f"Batch of {len(cmds)} cmds, ran {len(to_run)}, " +
+                    f"coalesced {len(cmds) - len(to_run)}, " +
+                    f"remakes {remakes} (saved {wanted_remake - remakes}), " +
+                    f"totals {stats}")
+        return all_ok
+
     def password_changed(self, data):
         self.need_remake_unix_files = True
         return True
@@ -476,10 +907,8 @@ class UserData:
         return False
 
     def find_user_by_email(self, email):
-        for user in self.all_users:
-            if self.all_users[user].get("email", "") == email:
-                return user
-        return None
+        users = uconfig.find_users("email", email)
+        return users[0] if users else None
 
     def request_password_reset(self, data):
         if (user := data.get("user", None)) is None or (pin := data.get(
@@ -492,10 +921,16 @@ class UserData:
         with open(os.path.join(policy.RESET_CODES, store_code), "w") as fd:
             json.dump({"user": user}, fd)
 
-        uconfig.update(user, {"events": {"desc": "Password reset requested"}})
+        uconfig.update(
+            user, {
+                "events": {
+                    "desc": "Password reset requested"
+                },
+                "password_reset": store_code
+            })
 
         return sendmail.post("request_password_reset", {
-            "user": self.all_users[user],
+            "user": self.all_users[user].full(),
             "reset_url_code": reset_url_code
         })
 
@@ -515,6 +950,7 @@ DOMS_CMDS = {
     "email_users_welcome": Users.email_users_welcome,
     "user_age_check": Users.user_age_check,
     "run_mx_check": Users.run_mx_check,
+    "recheck_user": Users.recheck_user,
     "remake_unix_files": Users.remake_unix_files_true,
     "remake_mail_files": Users.remake_mail_files_true,
     "start_up_new_files": Users.start_up_new_files,
@@ -533,36 +969,139 @@ def runner(with_debug, to_syslog):
     Users.finish_start_uo()
     log.log("DOMS backend running")
 
+    queue = executor.CommandQueue("doms")
     while True:
-        if (file := executor.find_oldest_cmd("doms")) is None:
-            time.sleep(1)
-        else:
-            with open(file, "r") as fd:
-                cmd_data = json.load(fd)
-            os.remove(file)
-            if "verb" not in cmd_data:
-                log.log(f"ERROR: 'verb' missing from '{cmd_data}' data")
-            elif cmd_data["verb"] not in DOMS_CMDS:
-                log.log(f"ERROR: Verb '{cmd_data['verb']}' is not supported")
-            else:
-                log.debug(f"Running cmd: '{cmd_data['verb']}'")
-                if not Users.dispatch_job(cmd_data["verb"],
-                                          cmd_data.get("data", None)):
-                    time.sleep(5)
+        if files := queue.drain():
+            cmds = []
+            cmd_files = []
+            for file in files:
+                with open(file, "r") as fd:
+                    cmd_data = json.load(fd)
+                if "verb" not in cmd_data:
+                    log.log(f"ERROR: 'verb' missing from '{cmd_data}' data")
+                    os.remove(file)
+                elif cmd_data["verb"] not in DOMS_CMDS:
+                    log.log(
+                        f"ERROR: Verb '{cmd_data['verb']}' is not supported")
+                    os.remove(file)
+                else:
+                    cmds.append(cmd_data)
+                    cmd_files.append(file)
+
+            if cmds and not Users.dispatch_batch(cmds, cmd_files):
+                time.sleep(5)
+
+        if Users.check_due_domains():
+            Users.check_remake_files()
+        elif not files:
+            queue.wait(Users.schedule.wait_time())
+
+
+def run_bench(count):
+    """ time loading {count} users cold, then warm from the snapshot """
+    save = (policy.USER_DIR, policy.DOMS_SNAPSHOT, uconfig.user_store)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy.USER_DIR = os.path.join(tmpdir, "users")
+        policy.DOMS_SNAPSHOT = os.path.join(tmpdir, "snapshot")
+        os.mkdir(policy.USER_DIR)
+        uconfig.user_store = uconfig.FileStore(policy.USER_DIR, 0)
+        for num in range(0, count):
+            uconfig.user_store.create(f"user{num}", uconfig.bench_user(num))
+
+        for desc, changes in [("cold", None), ("warm, none changed", 0),
+                              ("warm, 1% changed", count // 100)]:
+            if changes is None and os.path.isfile(policy.DOMS_SNAPSHOT):
+                os.remove(policy.DOMS_SNAPSHOT)
+            for num in random.sample(range(0, count), changes or 0):
+                uconfig.update(f"user{num}", {"last_login_dt": misc.now()})
+            start = time.perf_counter()
+            this_data = UserData()
+            this_data.load_user_details()
+            print(f"{count} users, {desc} -> " +
+                  f"{time.perf_counter() - start:.3f}s, " +
+                  f"{len(this_data.all_users)} loaded, " +
+                  f"{len(this_data.active_users)} active")
+    policy.USER_DIR, policy.DOMS_SNAPSHOT, uconfig.user_store = save
+
+
+def bench_memory(count):
+    """ memory to hold {count} users, as whole records, bare records & UserRecords """
+    texts = [json.dumps(uconfig.bench_user(num)) for num in range(0, count)]
+    for desc, make in [
+        ("whole", lambda user, js: uconfig.finish_load(user, js)[1]),
+        ("bare", uconfig.bare_record),
+        ("slotted", lambda user, js: UserRecord(uconfig.bare_record(user, js)))
+    ]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        users = {
+            f"user{num}": make(f"user{num}", json.loads(text))
+            for num, text in enumerate(texts)
+        }
+        taken = time.perf_counter() - start
+        size, __ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{count} users, {desc} -> {size / 1048576:.1f}MB, " +
+              f"{size / count:.0f} bytes each, {taken:.3f}s")
+        del users
+
+
+class StubResolver:
+    """ every domain points to {mx}, counting the lookups """
+
+    def __init__(self, mx):
+        self.mx = mx
+        self.lookups = {}
+
+    def resolv_many(self, names, qtype, mx_only=False, use_cache=True):
+        for name in names:
+            self.lookups[name] = self.lookups.get(name, 0) + 1
+        return {name: resolv.MxReply(0, [(10, self.mx)], 60) for name in names}
+
+
+def test_ladder_slice():
+    """ a domain on its last ladder step, due with another, is looked up once & doesn't change on one answer """
+    save = (policy.USER_DIR, uconfig.user_store)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy.USER_DIR = tmpdir
+        uconfig.user_store = uconfig.FileStore(tmpdir, 0)
+        js = {
+            "mx": "mx0",
+            "domains": {
+                "laddered.test": False,
+                "other.test": False
+            }
+        }
+        uconfig.user_store.create("user0", js)
+        this_data = UserData()
+        this_data.resolver = StubResolver(
+            ("mx0." + policy.get("email_domain")).rstrip(".").lower())
+        this_data.all_users = {"user0": UserRecord(dict(js, user="user0"))}
+        now = time.time() - 1
+        this_data.schedule.add("user0", "laddered.test", now, ladder=[])
+        this_data.schedule.add("user0", "other.test", now)
+        this_data.check_due_domains()
+        lookups = this_data.resolver.lookups
+        ok = (lookups == {
+            "laddered.test": 1,
+            "other.test": 1
+        } and not this_data.all_users["user0"].is_active("laddered.test"))
+        print(f"ladder slice -> {'OK' if ok else 'FAILED'}, lookups {lookups}")
+    policy.USER_DIR, uconfig.user_store = save
 
 
 def run_tests():
+    test_ladder_slice()
     Users.startup()
     print({
-        dom: Users.all_users[user]["domains"][dom]
+        dom: active
         for user in Users.active_users
-        for dom in Users.all_users[user].get("domains", {})
+        for dom, active in Users.all_users[user].domains().items()
     })
     print({
         dom: True
         for user in Users.active_users
-        for dom in Users.all_users[user].get("domains", {})
-        if Users.all_users[user]["domains"][dom]
+        for dom in Users.all_users[user].active_domains()
     })
 
 
@@ -583,10 +1122,27 @@ def main():
                         default=False,
                         help="Run tests",
                         action="store_true")
+    parser.add_argument("-B",
+                        "--bench",
+                        type=int,
+                        help="Benchmark start up with this many users")
+    parser.add_argument("-M",
+                        "--memory",
+                        type=int,
+                        help="Benchmark memory used by this many users")
     parser.add_argument("-O", "--one", help="Run one module")
     parser.add_argument("-d", "--data", help="data for running one")
     args = parser.parse_args()
 
+    if args.bench:
+        log.init("DOMS bench", with_debug=False, to_syslog=False)
+        run_bench(args.bench)
+        return
+
+    if args.memory:
+        bench_memory(args.memory)
+        return
+
     Users.startup()
     if args.one:
         log.init("DOMS run one",
@@ -597,6 +1153,7 @@ def main():
             return
         Users.dispatch_job(args.one,
                            json.loads(args.data) if args.data else None)
+        Users.finish_due_checks()
 
     elif args.test:
         log.init("DOMS run test", with_debug=args.debug, to_syslog=args.syslog)
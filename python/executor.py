@@ -4,20 +4,91 @@
 
 import os
 import json
+import time
+import select
+import ctypes
+import struct
+import heapq
+import re
 import tempfile
+import threading
 import glob
 import argparse
 
+EXEC_DIR = "/run/exec"
 
-def create_command(pfx, cmd_type, cmd_data):
-    dir = "/run/exec/" + cmd_type
-    if not os.path.isdir(dir):
+POLL_INTERVAL = 1
+WATCH_TIMEOUT = 60
+
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+INTERACTIVE = "interactive"
+NORMAL = "normal"
+BULK = "bulk"
+PRIORITIES = [INTERACTIVE, NORMAL, BULK]
+
+# seconds the oldest command in a lane can wait before it jumps the higher lanes
+LANE_MAX_WAIT = {NORMAL: 30, BULK: 300}
+
+CMD_NAME = re.compile(r"^(?:(interactive|normal|bulk)\.)?(?:([0-9]{20})\.)?")
+
+seq_lock = threading.Lock()
+last_seq = 0
+
+
+def cmd_dir(cmd_type):
+    return os.path.join(EXEC_DIR, cmd_type)
+
+
+def next_seq():
+    """ strictly increasing sequence, nanosecond clock based so it orders across processes """
+    global last_seq
+    with seq_lock:
+        last_seq = max(time.time_ns(), last_seq + 1)
+        return last_seq
+
+
+def cmd_sort_key(name, stat):
+    """ return lane & key, files we made carry their sequence, others (e.g. from shell scripts) use their mtime """
+    match = CMD_NAME.match(name)
+    lane = match.group(1) if match.group(1) is not None else NORMAL
+    if match.group(2) is not None:
+        return lane, (int(match.group(2)), name)
+    return lane, (stat.st_mtime_ns, name)
+
+
+def pick_lane(heads, now_ns=None):
+    """ {heads} is oldest key per lane, pick the most overdue lane, else the highest priority """
+    if now_ns is None:
+        now_ns = time.time_ns()
+    overdue = [(heads[lane], lane) for lane in PRIORITIES[1:]
+               if heads.get(lane, None) is not None and now_ns -
+               heads[lane][0] > LANE_MAX_WAIT[lane] * 1000000000]
+    if overdue:
+        return min(overdue)[1]
+    for lane in PRIORITIES:
+        if heads.get(lane, None) is not None:
+            return lane
+    return None
+
+
+def is_cmd_ready(stat):
+    return (stat.st_mode & 0o777) == 0o444
+
+
+def create_command(pfx, cmd_type, cmd_data, priority=NORMAL):
+    dir = cmd_dir(cmd_type)
+    if not os.path.isdir(dir) or priority not in PRIORITIES:
         return False
-    with tempfile.NamedTemporaryFile("w+",
-                                     dir=dir,
-                                     encoding="utf-8",
-                                     delete=False,
-                                     prefix=pfx + "_") as fd:
+    with tempfile.NamedTemporaryFile(
+            "w+",
+            dir=dir,
+            encoding="utf-8",
+            delete=False,
+            prefix=f"{priority}.{next_seq():020d}.{pfx}_") as fd:
         json.dump(cmd_data, fd)
         filename = fd.name
     fd.close()
@@ -26,20 +97,248 @@ def create_command(pfx, cmd_type, cmd_data):
 
 
 def find_oldest_cmd(cmd_type):
-    dir = "/run/exec/" + cmd_type
+    dir = cmd_dir(cmd_type)
     if not os.path.isdir(dir):
         return False
 
-    files = glob.glob(os.path.join(dir, '*'))
-    files = [
-        f for f in files
-        if os.path.isfile(f) and oct(os.stat(f).st_mode)[-3:] == "444"
-    ]
+    heads = {}
+    for file in glob.glob(os.path.join(dir, '*')):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        if os.path.isfile(file) and is_cmd_ready(stat):
+            lane, key = cmd_sort_key(os.path.basename(file), stat)
+            if lane not in heads or key < heads[lane]:
+                heads[lane] = key
+
+    if (lane := pick_lane(heads)) is None:
+        return None
+
+    return os.path.join(dir, heads[lane][1])
+
 
-    if not files:
+def inotify_watch(dir):
+    """ return an inotify fd watching {dir} for files being made ready, or None """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
         return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, dir.encode("utf-8"),
+                              IN_ATTRIB | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class Watcher:
+    """ sleep until a command file is ready, by inotify if we can, else by polling """
+
+    def __init__(self, cmd_type, with_inotify=True):
+        self.dir = cmd_dir(cmd_type)
+        self.fd = inotify_watch(self.dir) if with_inotify else None
+
+    def wait(self, timeout=None):
+        """ return names of files that might be ready, or None if we don't know """
+        if self.fd is None:
+            time.sleep(POLL_INTERVAL if timeout is
+                       None else min(timeout, POLL_INTERVAL))
+            return None
+
+        rlist, _, _ = select.select(
+            [self.fd], [], [],
+            WATCH_TIMEOUT if timeout is None else min(timeout, WATCH_TIMEOUT))
+        if len(rlist) <= 0:
+            return []
+        return self.drain()
+
+    def drain(self):
+        names = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            if len(buf) <= 0:
+                return names
+
+            pos = 0
+            while pos + INOTIFY_EVENT.size <= len(buf):
+                _, mask, _, name_len = INOTIFY_EVENT.unpack_from(buf, pos)
+                pos += INOTIFY_EVENT.size
+                if (mask & IN_Q_OVERFLOW) != 0:
+                    names = None
+                elif names is not None and name_len > 0:
+                    names.append(buf[pos:pos +
+                                     name_len].rstrip(b"\0").decode("utf-8"))
+                pos += name_len
+
+            if names is None:
+                self.drain()
+                return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class CommandQueue:
+    """ in-memory index of ready command files, oldest first, fed by the Watcher """
+
+    def __init__(self, cmd_type, with_inotify=True):
+        self.dir = cmd_dir(cmd_type)
+        self.watcher = Watcher(cmd_type, with_inotify)
+        self.ready = {lane: [] for lane in PRIORITIES}
+        self.queued = set()
+        self.rescan()
+
+    def add(self, name):
+        if name in self.queued:
+            return
+        try:
+            stat = os.stat(os.path.join(self.dir, name))
+        except FileNotFoundError:
+            return
+        if is_cmd_ready(stat):
+            self.queued.add(name)
+            lane, key = cmd_sort_key(name, stat)
+            heapq.heappush(self.ready[lane], key)
+
+    def rescan(self):
+        """ full directory scan, only at start-up, when polling or if inotify overflowed """
+        for entry in os.scandir(self.dir):
+            if entry.is_file():
+                self.add(entry.name)
+
+    def add_names(self, names):
+        if names is None:
+            self.rescan()
+        else:
+            for name in names:
+                self.add(name)
+
+    def next_cmd(self):
+        """ pop the next ready command file by priority & age, or None """
+        if self.watcher.fd is not None:
+            self.add_names(self.watcher.drain())
+        heads = {lane: heap[0] for lane, heap in self.ready.items() if heap}
+        if (lane := pick_lane(heads)) is None:
+            return None
+        __, name = heapq.heappop(self.ready[lane])
+        self.queued.discard(name)
+        return os.path.join(self.dir, name)
+
+    def drain(self):
+        """ pop every ready command file, in the order next_cmd would """
+        files = []
+        while (file := self.next_cmd()) is not None:
+            files.append(file)
+        return files
+
+    def wait(self, timeout=None):
+        self.add_names(self.watcher.wait(timeout))
+
+    def close(self):
+        self.watcher.close()
+
+
+def bench_consumer(queue, results, count):
+    while len(results) < count:
+        if (file := queue.next_cmd()) is None:
+            queue.wait()
+        else:
+            with open(file, "r") as fd:
+                cmd_data = json.load(fd)
+            os.remove(file)
+            results.append(time.perf_counter() - cmd_data["data"]["sent"])
+
+
+def bench_latency(with_inotify, count=50):
+    """ time enqueue -> dispatch for {count} commands, one at a time """
+    results = []
+    queue = CommandQueue("bench", with_inotify)
+    consumer = threading.Thread(target=bench_consumer,
+                                args=(queue, results, count))
+    consumer.start()
+    for x in range(0, count):
+        time.sleep(0.02 + (x % 7) / 100)
+        create_command("bench", "bench", {
+            "verb": "test",
+            "data": {
+                "sent": time.perf_counter()
+            }
+        })
+    consumer.join()
+    queue.close()
+    results.sort()
+    return results
+
+
+def bench_drain(count):
+    """ time draining a burst of {count} commands, full scan vs queue index """
+    ret = {}
+    for how in ["scan", "index"]:
+        for x in range(0, count):
+            create_command("bench", "bench", {"verb": "test"})
+        order = []
+        start = time.perf_counter()
+        if how == "scan":
+            while (file := find_oldest_cmd("bench")) is not None:
+                order.append(file)
+                os.remove(file)
+        else:
+            queue = CommandQueue("bench")
+            while (file := queue.next_cmd()) is not None:
+                order.append(file)
+                os.remove(file)
+            queue.close()
+        ret[how] = time.perf_counter() - start
+        if order != sorted(order):
+            print(f"ERROR: {how} drained out of order")
+    return ret
+
+
+def bench_lanes(count=20):
+    """ check a bulk backlog doesn't hold up interactive commands """
+    for x in range(0, count):
+        create_command("bench", "bench", {"verb": "sweep"}, BULK)
+    create_command("bench", "bench", {"verb": "login"}, INTERACTIVE)
+    queue = CommandQueue("bench")
+    order = []
+    while (file := queue.next_cmd()) is not None:
+        with open(file, "r") as fd:
+            order.append(json.load(fd)["verb"])
+        os.remove(file)
+    queue.close()
+    return order.index("login")
+
+
+def run_bench():
+    global EXEC_DIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        EXEC_DIR = tmpdir
+        os.mkdir(cmd_dir("bench"))
+        for with_inotify in [True, False]:
+            if with_inotify and Watcher("bench").fd is None:
+                print("inotify -> not available")
+                continue
+            results = bench_latency(with_inotify)
+            print(f"{'inotify' if with_inotify else 'polling'} -> "
+                  f"mean {sum(results) / len(results) * 1000:.2f}ms, "
+                  f"median {results[int(len(results) / 2)] * 1000:.2f}ms, "
+                  f"max {results[-1] * 1000:.2f}ms")
+
+        print("interactive behind 20 bulk -> dispatched at position",
+              bench_lanes())
 
-    return min(files, key=os.path.getmtime)
+        for count in [100, 1000]:
+            ret = bench_drain(count)
+            print(f"drain {count} -> scan {ret['scan'] * 1000:.1f}ms, "
+                  f"index {ret['index'] * 1000:.1f}ms")
 
 
 def run_tests():
@@ -60,9 +359,22 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--type", help="Command type (root/doms)")
     parser.add_argument("-d", "--data", help="Command data")
     parser.add_argument("-v", "--verb", help="Command verb")
+    parser.add_argument("-p",
+                        "--priority",
+                        default=NORMAL,
+                        choices=PRIORITIES,
+                        help="Command priority")
+    parser.add_argument("-B",
+                        "--bench",
+                        default=False,
+                        help="Benchmark enqueue to dispatch latency",
+                        action="store_true")
     args = parser.parse_args()
-    send_data = {"verb": args.verb}
-    if args.data:
-        send_data["data"] = json.loads(args.data)
+    if args.bench:
+        run_bench()
+    else:
+        send_data = {"verb": args.verb}
+        if args.data:
+            send_data["data"] = json.loads(args.data)
 
-    create_command("manual", args.type, send_data)
+        create_command("manual", args.type, send_data, args.priority)
@@ -3,6 +3,7 @@
 # Alternative license arrangements possible, contact me for more information
 
 import datetime
+import functools
 import idna
 import hashlib
 import secrets
@@ -12,6 +13,8 @@ import os
 
 from policy import this_policy as policy
 
+IDNA_CACHE_SIZE = 10000
+
 
 def is_user_active(user_data):
     if (user := user_data.get("user", None)) is None:
@@ -40,6 +43,7 @@ def now(offset=0):
     return time_now.strftime("%Y-%m-%d %H:%M:%S")
 
 
+@functools.lru_cache(maxsize=IDNA_CACHE_SIZE)
 def puny_to_utf8(name):
     try:
         idn = idna.decode(name)
@@ -53,6 +57,7 @@ def puny_to_utf8(name):
     return None
 
 
+@functools.lru_cache(maxsize=IDNA_CACHE_SIZE)
 def utf8_to_puny(utf8):
     try:
         puny = idna.encode(utf8)
@@ -66,6 +71,22 @@ def utf8_to_puny(utf8):
     return None
 
 
+def puny_to_utf8_many(names):
+    return [puny_to_utf8(name) for name in names]
+
+
+def utf8_to_puny_many(names):
+    return [utf8_to_puny(name) for name in names]
+
+
+def idna_cache_stats():
+    """ hits, misses & size of the IDNA caches, lru_cache is thread-safe, so they can be shared """
+    return {
+        func.__name__: func.cache_info()._asdict()
+        for func in [puny_to_utf8, utf8_to_puny]
+    }
+
+
 def debug_mode():
     return os.environ.get("DEBUG_MODE", "N") == "Y"
 
@@ -108,6 +129,7 @@ if __name__ == "__main__":
     print(puny_to_utf8("xn--v86cr064b"))
     print(utf8_to_puny("👁️"))
     print(utf8_to_puny("👁"))
+    print(idna_cache_stats())
 
 
 def not_this_time():
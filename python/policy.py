@@ -18,6 +18,21 @@ DEFAULT_POLICY_VALUES = {
     "session_expiry": 60 * 60 * 2,
     "never_active_account_expire": 7,
     "was_active_account_expire": 30,
+    "sweep_slice_size": 100,
+    "mx_check_min_interval": 60,
+    "mx_check_max_interval": 86400,
+    "mx_flap_agree": 2,
+    "mx_flap_dwell": 300,
+    "mx_check_retry_ladder": [5, 10, 20, 40, 60, 120, 300],
+    "recheck_min_interval": 60,
+    "dns_cache_size": 10000,
+    "user_store": "files",
+    "user_cache_size": 1000,
+    "events_file_size": 32768,
+    "events_max": 200,
+    "load_workers": 1,
+    "tld_index_axfr_server": None,
+    "tld_index_max_age": 60 * 60 * 24 * 7,
     "manager_account": "manager",
     "dns_supports_authoritative": False,
     "icann_smtp_relay": None,
@@ -40,13 +55,19 @@ class Policy:
         self.POLICY_FILE = os.path.join(self.SERVICE, "config", "policy.json")
         self.DOMAINS_FILE = os.path.join(self.SERVICE, "config",
                                          "used_domains.json")
+        self.TLD_INDEX_FILE = os.path.join(self.SERVICE, "config",
+                                           "hns_tlds.txt")
         self.USER_DIR = os.path.join(self.SERVICE, "users")
+        self.USER_DB = os.path.join(self.SERVICE, "users.db")
+        self.DOMS_SNAPSHOT = os.path.join(self.SERVICE, "doms_snapshot")
         self.HOME_DIR = os.path.join(self.SERVICE, "homedirs")
         self.MBOX_DIR = os.path.join(self.SERVICE, "mailboxes")
         self.EMAILS_DIR = os.path.join(self.SERVICE, "emails")
         self.SESSIONS_DIR = os.path.join(self.SERVICE, "sessions")
         self.RESET_CODES = os.path.join(self.SERVICE, "reset_codes")
+        self.RECHECK_DIR = os.path.join(self.SERVICE, "recheck")
         self.BASE_UX_DIR = "/usr/local/etc/uid"
+        self.DNS_CACHE_FILE = "/run/dns/cache.db"
 
         if not os.path.isfile(self.POLICY_FILE):
             with open(self.POLICY_FILE, "w+") as fd:
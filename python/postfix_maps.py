@@ -0,0 +1,90 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2025, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" the postfix tables the DOMS runner makes & the root runner installs, either whole or as deltas """
+
+import os
+import json
+import glob
+
+import executor
+from policy import this_policy as policy
+
+MAPS = ["transport", "local", "virtual"]
+
+
+def map_dir():
+    return os.path.join(policy.BASE, "postfix", "data")
+
+
+def map_file(name):
+    return os.path.join(map_dir(), name)
+
+
+def read_map(path):
+    """ table source file {path} as {key: value}, empty if there isn't one """
+    entries = {}
+    try:
+        with open(path, "r") as fd:
+            for line in fd:
+                parts = line.split(maxsplit=1)
+                if len(parts) == 2 and parts[0][0] != "#":
+                    entries[parts[0]] = parts[1].strip()
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def write_map(path, entries):
+    with open(path, "w") as fd:
+        for key, value in entries.items():
+            fd.write(f"{key} {value}\n")
+
+
+def diff_map(old, new):
+    """ what changes table {old} into {new}, keys whose value changed are just added again """
+    return {
+        "add": {
+            key: value
+            for key, value in new.items() if old.get(key, None) != value
+        },
+        "remove": [key for key in old if key not in new]
+    }
+
+
+def apply_delta(entries, delta):
+    for key in delta["remove"]:
+        entries.pop(key, None)
+    entries.update(delta["add"])
+    return entries
+
+
+def delta_files():
+    """ deltas waiting to be installed, oldest first """
+    return sorted(glob.glob(os.path.join(map_dir(), "maps.*.delta")))
+
+
+def save_delta(deltas):
+    """ {deltas} is {map: delta}, the sequence in the name keeps them in order """
+    path = os.path.join(map_dir(), f"maps.{executor.next_seq():020d}.delta")
+    with open(path + ".tmp", "w") as fd:
+        json.dump(deltas, fd)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def load_delta(path):
+    try:
+        with open(path, "r") as fd:
+            return json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def remove_deltas():
+    """ a whole set of tables replaces any deltas still waiting """
+    for path in delta_files():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -9,10 +9,20 @@ import argparse
 import os
 import base64
 import json
+import time
+import copy
+import struct
+import timeit
+import threading
+import collections
+import sqlite3
+import multiprocessing
+import tempfile
 import dns
 import dns.name
 import dns.message
 import dns.rdatatype
+import dns.rrset
 import validators
 
 import validation
@@ -20,6 +30,23 @@ from log import this_log as log
 
 DNS_MAX_RESP = 4096
 MAX_TRIES = 5
+MAX_IN_FLIGHT = 200
+SOCK_POOL_SIZE = 32
+TCP_POOL_SIZE = 4
+TCP_TIMEOUT = 5
+TCP_IDLE_TIMEOUT = 10
+TCP_MAX_RESP = 65535
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 6.0
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+LOSS_ALPHA = 0.2
+RR_SOA = 6
+CACHE_MAX_SIZE = 10000
+CACHE_MAX_TTL = 86400
+CACHE_MAX_NEG_TTL = 3600
+SHARED_PURGE_EVERY = 1000
 DNS_FLAGS = {
     "QR": 0x8000,
     "AA": 0x0400,
@@ -56,10 +83,357 @@ class ResolvError(Exception):
     """ custom error """
 
 
+MxReply = collections.namedtuple("MxReply", ["rcode", "mx", "ttl"])
+RR_HEADER = struct.Struct("!HHIH")
+
+
+def wire_name(wire, pos):
+    """ read a (maybe compressed) name at {pos}, returns name & position after it """
+    labels = []
+    end = None
+    for __ in range(0, 128):
+        length = wire[pos]
+        if length == 0:
+            return ".".join(labels).lower(), (pos + 1 if end is None else end)
+        if (length & 0xC0) == 0xC0:
+            if end is None:
+                end = pos + 2
+            pos = ((length & 0x3F) << 8) | wire[pos + 1]
+        else:
+            labels.append(wire[pos + 1:pos + 1 + length].decode("latin-1"))
+            pos += length + 1
+    raise ValueError("Name compression loop")
+
+
+def skip_wire_name(wire, pos):
+    while wire[pos] != 0:
+        if (wire[pos] & 0xC0) == 0xC0:
+            return pos + 2
+        pos += wire[pos] + 1
+    return pos + 1
+
+
+def decode_mx(wire):
+    """ decode just the MX records of wire format reply, returns MxReply or None.
+        Only Answer is parsed, Authority only for the SOA of a negative reply """
+    try:
+        if (wire[2] & 0x80) == 0:
+            return None  # REPLY flag not set
+        rcode = wire[3] & 0xF
+        qdcount, ancount, nscount = struct.unpack_from("!HHH", wire, 4)
+        pos = 12
+        for __ in range(0, qdcount):
+            pos = skip_wire_name(wire, pos) + 4
+
+        mx = []
+        ttl = CACHE_MAX_TTL
+        for __ in range(0, ancount):
+            pos = skip_wire_name(wire, pos)
+            rr_type, __, rr_ttl, rdlen = RR_HEADER.unpack_from(wire, pos)
+            pos += RR_HEADER.size
+            if rr_type == dns.rdatatype.MX:
+                exchange, __ = wire_name(wire, pos + 2)
+                mx.append((struct.unpack_from("!H", wire, pos)[0], exchange))
+                ttl = min(ttl, rr_ttl)
+            pos += rdlen
+
+        if mx or rcode not in [0, 3]:
+            return MxReply(rcode, tuple(mx), ttl if mx else 0)
+
+        for __ in range(0, nscount):
+            pos = skip_wire_name(wire, pos)
+            rr_type, __, rr_ttl, rdlen = RR_HEADER.unpack_from(wire, pos)
+            pos += RR_HEADER.size
+            if rr_type == RR_SOA:
+                minimum = struct.unpack_from("!I", wire, pos + rdlen - 4)[0]
+                return MxReply(rcode, (), min(rr_ttl, minimum))
+            pos += rdlen
+
+        return MxReply(rcode, (), 0)
+    except (IndexError, ValueError, struct.error, UnicodeError):
+        return None
+
+
+def negative_ttl(reply):
+    """ RFC 2308, lesser of SOA TTL & SOA MINIMUM, no SOA means don't cache """
+    for rr in reply.get("Authority", []):
+        if rr.get("type", 0) == RR_SOA:
+            return min(rr["TTL"], int(rr["data"].split()[-1]))
+    return 0
+
+
+def reply_ttl(reply):
+    """ how long {reply} can be cached for, 0 if it shouldn't be """
+    if isinstance(reply, MxReply):
+        return min(CACHE_MAX_TTL if reply.mx else CACHE_MAX_NEG_TTL, reply.ttl)
+    if reply.get("Status", 99) == 0 and len(reply.get("Answer", [])) > 0:
+        return min(CACHE_MAX_TTL, min(rr["TTL"] for rr in reply["Answer"]))
+    if reply.get("Status", 99) in [0, 3]:
+        return min(CACHE_MAX_NEG_TTL, negative_ttl(reply))
+    return 0
+
+
+def encode_reply(reply):
+    if isinstance(reply, MxReply):
+        return json.dumps(["mx", reply.rcode, reply.mx, reply.ttl])
+    return json.dumps(["doh", reply])
+
+
+def decode_cached_reply(data):
+    js = json.loads(data)
+    if js[0] == "mx":
+        return MxReply(js[1], tuple(tuple(mx) for mx in js[2]), js[3])
+    return js[1]
+
+
+class SharedDnsCache:
+    """ DNS cache in an SQLite WAL database, shared by all processes on the box
+        readers don't block each other or the writer, expired rows are purged now & then """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.puts = 0
+
+    def db(self):
+        """ sqlite connections can't be shared between threads, so one each """
+        if (conn := getattr(self.local, "conn", None)) is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache " +
+                         "(key TEXT PRIMARY KEY, expiry REAL, reply TEXT) " +
+                         "WITHOUT ROWID")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        """ returns (secs left, reply) or None """
+        try:
+            row = self.db().execute(
+                "SELECT expiry, reply FROM cache WHERE key = ?",
+                (repr(key), )).fetchone()
+        except sqlite3.Error as err:
+            log.debug(f"Shared DNS cache: {err}")
+            return None
+        if row is None or (ttl := row[0] - time.time()) <= 0:
+            return None
+        return ttl, decode_cached_reply(row[1])
+
+    def put(self, key, reply, ttl):
+        now = time.time()
+        try:
+            conn = self.db()
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                         (repr(key), now + ttl, encode_reply(reply)))
+            self.puts += 1
+            if self.puts % SHARED_PURGE_EVERY == 0:
+                conn.execute("DELETE FROM cache WHERE expiry < ?", (now, ))
+        except sqlite3.Error as err:
+            log.debug(f"Shared DNS cache: {err}")
+
+
+class DnsCache:
+    """ size bounded LRU cache of decoded replies, honouring their TTLs
+        with an optional <SharedDnsCache> behind it for misses """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, shared=None):
+        self.max_size = max_size
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evicted": 0,
+            "negative": 0,
+            "shared_hits": 0
+        }
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.stats["expired"] += 1
+                entry = None
+
+            if entry is None:
+                self.stats["misses"] += 1
+            else:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+
+        if entry is None:
+            return self.get_shared(key)
+        return copy.deepcopy(entry[1])
+
+    def get_shared(self, key):
+        """ on a miss, try the shared cache & keep what it has for the rest of its TTL """
+        if self.shared is None or (ret := self.shared.get(key)) is None:
+            return None
+        ttl, reply = ret
+        with self.lock:
+            self.stats["shared_hits"] += 1
+        self.store(key, reply, ttl)
+        return reply
+
+    def put(self, key, reply):
+        if (ttl := reply_ttl(reply)) <= 0:
+            return
+        self.store(key, reply, ttl)
+        if self.shared is not None:
+            self.shared.put(key, reply, ttl)
+
+    def store(self, key, reply, ttl):
+        if isinstance(reply, MxReply):
+            is_negative = not reply.mx
+        else:
+            is_negative = (reply.get("Status", 99) != 0
+                           or len(reply.get("Answer", [])) == 0)
+
+        entry = (time.monotonic() + ttl, copy.deepcopy(reply))
+        with self.lock:
+            if is_negative:
+                self.stats["negative"] += 1
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def info(self):
+        with self.lock:
+            return dict(self.stats, size=len(self.entries))
+
+
+class ServerStats:
+    """ smoothed RTT (RFC 6298 style) & loss rate of one nameserver """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.loss = 0.0
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+
+    def rto(self):
+        """ how long to wait for this server before asking the next one """
+        if self.srtt is None:
+            return INITIAL_RTO
+        return min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def score(self):
+        """ lower is better, servers we've not tried yet go first so they get measured """
+        if self.srtt is None:
+            return 0 if self.sent == 0 else INITIAL_RTO * (1 + 10 * self.loss)
+        return self.srtt * (1 + 10 * self.loss)
+
+    def answered_in(self, rtt):
+        self.answered += 1
+        self.loss = (1 - LOSS_ALPHA) * self.loss
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (
+                1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+
+    def timed_out(self):
+        self.timeouts += 1
+        self.loss = (1 - LOSS_ALPHA) * self.loss + LOSS_ALPHA
+
+    def info(self):
+        return {
+            "srtt": self.srtt,
+            "rttvar": self.rttvar,
+            "rto": self.rto(),
+            "loss": self.loss,
+            "sent": self.sent,
+            "answered": self.answered,
+            "timeouts": self.timeouts
+        }
+
+
+def same_question(question, reply):
+    """ compare the question section in wire format, to avoid a full decode """
+    qlen = skip_wire_name(question, 12) - 12
+    return (reply[4:6] == b"\0\1"
+            and reply[12:12 + qlen].lower() == question[12:12 + qlen].lower()
+            and reply[12 + qlen:16 + qlen] == question[12 + qlen:16 + qlen])
+
+
+class TcpConn:
+    """ one persistent DNS over TCP connection, RFC 7766 framing & pipelining """
+
+    def __init__(self, addr, port):
+        self.addr = addr
+        self.sock = socket.create_connection((addr, port), timeout=TCP_TIMEOUT)
+        self.buf = memoryview(bytearray(TCP_MAX_RESP))
+        self.answered = 0
+        self.last_used = time.monotonic()
+
+    def is_stale(self, now):
+        """ idle too long, or readable when idle, which means the server closed it """
+        if now - self.last_used > TCP_IDLE_TIMEOUT:
+            return True
+        try:
+            return len(select.select([self.sock], [], [], 0)[0]) > 0
+        except (OSError, ValueError):
+            return True
+
+    def read_exact(self, length):
+        """ read {length} bytes into our buffer, no copying as it arrives """
+        got = 0
+        while got < length:
+            if (size := self.sock.recv_into(self.buf[got:length])) <= 0:
+                raise ConnectionError("DNS TCP connection closed")
+            got += size
+        return self.buf[:length]
+
+    def ask(self, questions):
+        """ send all {questions} back to back, replies can come in any order, matched on query id """
+        self.sock.sendall(b"".join(
+            len(question).to_bytes(2, "big") + question
+            for question in questions))
+        want = {}
+        for pos, question in enumerate(questions):
+            want.setdefault(bytes(question[:2]), []).append(pos)
+
+        replies = [None] * len(questions)
+        waiting = len(questions)
+        while waiting > 0:
+            length = int.from_bytes(self.read_exact(2), "big")
+            reply = bytes(self.read_exact(length))
+            if len(want.get(reply[:2], [])) > 0:
+                replies[want[reply[:2]].pop(0)] = reply
+                waiting -= 1
+
+        self.answered += len(questions)
+        self.last_used = time.monotonic()
+        return replies
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
 class Resolver:
-    """ resolve a DNS <Query> """
+    """ resolve a DNS <Query>, all per-query state is kept in a <qry> dict
+        so one Resolver can be shared by many threads """
 
-    def __init__(self, servers=None):
+    def __init__(self, servers=None, cache=None, port=53):
+        self.cache = cache
+        self.port = port
+        self.server_stats = {}
+        self.lock = threading.Lock()
+        self.sock_pool = []
+        self.tcp_pool = {}
         self.servers = None
         if servers is None:
             with open("/etc/resolv.conf", "r") as fd:
@@ -81,14 +455,87 @@ class Resolver:
         if self.servers is None or not isinstance(self.servers, list):
             raise ResolvError("Failed to identify servers")
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self.sock is None:
-            raise ResolvError("Failed to open UDP client socket")
-
         for each_svr in self.servers:
             if not validators.ip_address.ipv4(each_svr):
                 raise ResolvError("Invalid IP v4 Address for a Server")
 
+    def get_sock(self):
+        """ borrow a UDP socket from the pool, or open a new one """
+        with self.lock:
+            if len(self.sock_pool) > 0:
+                return self.sock_pool.pop()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if sock is None:
+            raise ResolvError("Failed to open UDP client socket")
+        return sock
+
+    def put_sock(self, sock):
+        """ give {sock} back to the pool, dropping any late replies left on it """
+        try:
+            while len(select.select([sock], [], [], 0)[0]) > 0:
+                sock.recv(DNS_MAX_RESP)
+        except OSError:
+            sock.close()
+            return
+        with self.lock:
+            if len(self.sock_pool) < SOCK_POOL_SIZE:
+                self.sock_pool.append(sock)
+                return
+        sock.close()
+
+    def get_tcp(self, addr):
+        """ borrow a live TCP connection to {addr}, or open a new one """
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            conns = self.tcp_pool.get(addr, [])
+            while conn is None and len(conns) > 0:
+                if (this_conn := conns.pop()).is_stale(now):
+                    stale.append(this_conn)
+                else:
+                    conn = this_conn
+        for this_conn in stale:
+            this_conn.close()
+        return TcpConn(addr, self.port) if conn is None else conn
+
+    def put_tcp(self, conn):
+        """ give {conn} back to the pool & reap connections that have been idle too long """
+        now = time.monotonic()
+        idle = []
+        with self.lock:
+            conns = self.tcp_pool.setdefault(conn.addr, [])
+            if len(conns) < TCP_POOL_SIZE:
+                conns.append(conn)
+            else:
+                idle.append(conn)
+            for conns in self.tcp_pool.values():
+                idle.extend(this_conn for this_conn in conns
+                            if now - this_conn.last_used > TCP_IDLE_TIMEOUT)
+                conns[:] = [
+                    this_conn for this_conn in conns
+                    if now - this_conn.last_used <= TCP_IDLE_TIMEOUT
+                ]
+        for this_conn in idle:
+            this_conn.close()
+
+    def ask_tcp(self, addr, questions):
+        """ ask all {questions} of {addr} pipelined on one pooled connection """
+        for attempt in range(0, 2):
+            conn = self.get_tcp(addr)
+            try:
+                replies = conn.ask(questions)
+            except OSError:
+                conn.close()
+                if conn.answered == 0 or attempt > 0:
+                    raise
+                continue  # server dropped a reused connection, try a new one
+            self.put_tcp(conn)
+            return replies
+
+    def ask_in_tcp(self, addr, question):
+        return self.ask_tcp(addr, [question])[0]
+
     def resolv(self,
                name,
                rdtype,
@@ -96,131 +543,318 @@ class Resolver:
                flags=DNS_FLAGS["RD"],
                with_dnssec=False,
                include_raw=False,
-               servers=None):
+               servers=None,
+               use_cache=True):
         if not validation.is_valid_account(name):
             raise ResolvError(f"Hostname '{name}' failed validation")
 
-        if servers is not None:
-            self.this_servers = servers
-        else:
-            self.this_servers = self.servers
+        rdtype = int(rdtype) if isinstance(
+            rdtype, int) else dns.rdatatype.from_text(rdtype)
 
-        self.qryid = None
-        self.reply = None
-        self.flags = flags
-        self.force_tcp = force_tcp
-        self.include_raw = include_raw
-        if with_dnssec:
-            self.include_raw = True
+        cache_key = None
+        if self.cache is not None and use_cache and servers is None:
+            cache_key = (name.rstrip(".").lower(), rdtype, flags, with_dnssec,
+                         include_raw)
+            if (ret := self.cache.get(cache_key)) is not None:
+                return ret
 
+        msg = dns.message.make_query(name,
+                                     rdtype,
+                                     payload=30000,
+                                     want_dnssec=with_dnssec,
+                                     flags=flags)
+        qry = self.new_query(msg,
+                             servers,
+                             force_tcp=force_tcp,
+                             include_raw=(include_raw or with_dnssec))
+        ret = self.do_resolv(qry)
+        if cache_key is not None and ret is not None:
+            self.cache.put(cache_key, ret)
+        return ret
+
+    def resolv_mx(self,
+                  name,
+                  flags=DNS_FLAGS["RD"],
+                  use_cache=True,
+                  servers=None):
+        """ MX lookup decoded straight from the wire, returns MxReply(rcode, ((pref, exchange), ...), ttl) """
         if not validation.is_valid_account(name):
             raise ResolvError(f"Hostname '{name}' failed validation")
 
-        rdtype = int(rdtype) if isinstance(
-            rdtype, int) else dns.rdatatype.from_text(rdtype)
+        cache_key = None
+        if self.cache is not None and use_cache and servers is None:
+            cache_key = (name.rstrip(".").lower(), dns.rdatatype.MX, flags,
+                         False, "mx")
+            if (ret := self.cache.get(cache_key)) is not None:
+                return ret
 
-        self.expiry = 1
-        self.tries = 0
         msg = dns.message.make_query(name,
-                                     rdtype,
+                                     dns.rdatatype.MX,
                                      payload=30000,
-                                     want_dnssec=with_dnssec,
-                                     flags=self.flags)
-        self.question = bytearray(msg.to_wire())
-        return self.do_resolv()
-
-    def send_all(self):
-        """ send the query to all servers """
-        ret = False
-        for each_svr in self.this_servers:
+                                     flags=flags)
+        ret = self.do_resolv(self.new_query(msg, servers, mx_only=True))
+        if cache_key is not None and ret is not None:
+            self.cache.put(cache_key, ret)
+        return ret
+
+    def stats_for(self, server):
+        if (stats := self.server_stats.get(server, None)) is None:
+            stats = self.server_stats.setdefault(server, ServerStats())
+        return stats
+
+    def server_order(self, servers):
+        """ best server first """
+        return sorted(servers, key=lambda svr: self.stats_for(svr).score())
+
+    def server_info(self):
+        with self.lock:
+            return {
+                svr: stats.info()
+                for svr, stats in self.server_stats.items()
+            }
+
+    def send_next(self, sock, qry):
+        """ send {qry} to the next server in its order & set how long to wait for it """
+        order = qry["order"]
+        svr = order[qry["tries"] % len(order)]
+        stats = self.stats_for(svr)
+        backoff = 2**int(qry["tries"] / len(order))
+        now = time.monotonic()
+        qry["server"] = svr
+        qry["timeout"] = now + min(MAX_RTO, stats.rto() * backoff)
+        # Karn's rule, once a server has been sent it twice, its reply can't be timed
+        qry["sent"][svr] = None if svr in qry["sent"] else now
+        with self.lock:
+            stats.sent += 1
+        try:
+            sock.sendto(qry["question"], (svr, self.port))
+        except OSError as err:
+            log.log(f"RESOLVER: send_next - {str(err)}")
+            qry["timeout"] = now
+            return False
+        return True
+
+    def query_timed_out(self, qry):
+        """ record the timeout, True if {qry} has run out of tries """
+        stats = self.stats_for(qry["server"])
+        with self.lock:
+            stats.timed_out()
+        qry["tries"] += 1
+        return qry["tries"] >= MAX_TRIES * len(qry["order"])
+
+    def query_answered(self, qry, addr):
+        if qry["sent"].get(addr, None) is not None:
+            stats = self.stats_for(addr)
+            with self.lock:
+                stats.answered_in(time.monotonic() - qry["sent"][addr])
+
+    def new_query(self,
+                  msg,
+                  servers=None,
+                  mx_only=False,
+                  force_tcp=False,
+                  include_raw=False):
+        """ everything about one query, so nothing query specific lives on self """
+        return {
+            "question":
+            bytearray(msg.to_wire()),
+            "order":
+            self.server_order(self.servers if servers is None else servers),
+            "tries":
+            0,
+            "sent": {},
+            "mx_only":
+            mx_only,
+            "force_tcp":
+            force_tcp,
+            "include_raw":
+            include_raw
+        }
+
+    def new_qryid(self, qry):
+        """ give the DNS query a random non-zero Id """
+        while True:
+            qryid = os.urandom(2)
+            if qryid != b"\0\0":
+                break
+        qry["question"][0] = qryid[0]
+        qry["question"][1] = qryid[1]
+
+    def match_id(self, qry, reply, addr):
+        """ check the reply is to what we asked & from a server we asked, as pooled sockets
+            can still get late replies to earlier queries """
+        return (reply[:2] == qry["question"][:2] and addr in qry["sent"]
+                and same_question(qry["question"], reply))
+
+    def do_resolv(self, qry):
+        sock = self.get_sock()
+        try:
+            return self.ask_servers(sock, qry)
+        finally:
+            self.put_sock(sock)
+
+    def ask_servers(self, sock, qry):
+        """ ask the best server, hedge to the next one each time one times out """
+        self.new_qryid(qry)
+        while True:
+            if self.send_next(sock, qry):
+                while (wait := qry["timeout"] - time.monotonic()) > 0:
+                    rlist, _, _ = select.select([sock], [], [], wait)
+                    if len(rlist) <= 0:
+                        break
+
+                    reply, (addr, _) = sock.recvfrom(DNS_MAX_RESP)
+                    if self.match_id(qry, reply, addr):
+                        self.query_answered(qry, addr)
+                        return self.one_reply(qry, reply, addr)
+
+            if self.query_timed_out(qry):
+                return None
+
+    def needs_tcp(self, qry, reply):
+        return (reply[2] & 0x02) > 0 or qry["force_tcp"]
+
+    def one_reply(self, qry, reply, addr):
+        """ decode the {reply} to {qry}, asking again in TCP if it was truncated """
+        if self.needs_tcp(qry, reply):
             try:
-                sent_len = self.sock.sendto(self.question, (each_svr, 53))
-                ret = ret or (sent_len == len(self.question))
-            # pylint: disable=broad-except
-            except Exception as err:
-                log.log(f"RESOLVER: send_all - {str(err)}")
+                reply = self.ask_in_tcp(addr, qry["question"])
+            except OSError as e:
+                log.debug(f"DNS TCP error: {e}")
+                return None
+        return self.decode_wire(qry, reply, addr)
 
-        return ret  # True if at least one worked
+    def decode_wire(self, qry, reply, addr):
+        if qry["mx_only"]:
+            return decode_mx(reply)
 
-    def send(self):
-        """ send the DNS query out """
-        if self.question is None:
+        try:
+            decoded_resp = dns.message.from_wire(reply)
+        except dns.exception.DNSException as e:
+            log.debug(f"DNS read error: {e}")
             return None
-        self.question[0] = 0
-        self.question[1] = 0
-        while self.question[0] == 0 and self.question[1] == 0:
-            self.qryid = os.urandom(2)
-            self.question[0] = self.qryid[0]
-            self.question[1] = self.qryid[1]
-
-        return self.send_all()
-
-    def match_id(self):
-        """ cehck the DNS quiery Id field matches what we asked """
-        return (self.qryid is not None and self.reply[0] == self.qryid[0]
-                and self.reply[1] == self.qryid[1])
-
-    def do_resolv(self):
-        """ look for dns UDP response and read it """
-        if self.sock is None:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        while self.tries < MAX_TRIES:
-            if not self.send():
-                self.sock.close()
-                self.sock = None
-                return None
 
-            while True:
-                rlist, _, _ = select.select([self.sock], [], [], self.expiry)
-                if len(rlist) <= 0:
-                    break
+        if (ret := self.decode_reply(decoded_resp,
+                                     qry["include_raw"])) is not None:
+            ret["Responder"] = addr
+        return ret
 
-                self.reply, (addr, _) = self.sock.recvfrom(DNS_MAX_RESP)
-                if self.match_id():
-                    try:
-                        self.decoded_resp = dns.message.from_wire(self.reply)
-                    except dns.exception.FormError as e:
-                        log.debug(f"DNS read error: {e}")
-                        return None
+    def resolv_many(self,
+                    names,
+                    rdtype,
+                    flags=DNS_FLAGS["RD"],
+                    with_dnssec=False,
+                    use_cache=True,
+                    max_in_flight=MAX_IN_FLIGHT,
+                    mx_only=False):
+        """ resolve all {names} with many queries in flight, returns { name: reply-or-None }
+            with {mx_only} replies are MxReply, as from resolv_mx """
+        rdtype = int(rdtype) if isinstance(
+            rdtype, int) else dns.rdatatype.from_text(rdtype)
+        if mx_only:
+            rdtype = dns.rdatatype.MX
+            with_dnssec = False
+        cache_tag = "mx" if mx_only else with_dnssec
 
-                    if (self.decoded_resp.flags
-                            & DNS_FLAGS["TC"]) > 0 or self.force_tcp:
-                        self.reply = self.ask_in_tcp(addr)
-                        self.decoded_resp = dns.message.from_wire(self.reply)
+        results = {}
+        todo = collections.deque()
+        for name in names:
+            if name in results or name in todo:
+                continue
+            if not validation.is_valid_account(name):
+                results[name] = None
+                continue
+            cache_key = (name.rstrip(".").lower(), rdtype, flags, with_dnssec,
+                         cache_tag)
+            if self.cache is not None and use_cache and (
+                    ret := self.cache.get(cache_key)) is not None:
+                results[name] = ret
+            else:
+                todo.append(name)
 
-                    if (ret := self.decode_reply()) is None:
-                        return None
+        sock = self.get_sock()
+        try:
+            self.ask_many(sock, todo, results, rdtype, flags, with_dnssec,
+                          max_in_flight, mx_only)
+        finally:
+            self.put_sock(sock)
+        return results
 
-                    ret["Responder"] = addr
-                    return ret
+    def ask_many(self, sock, todo, results, rdtype, flags, with_dnssec,
+                 max_in_flight, mx_only):
+        cache_tag = "mx" if mx_only else with_dnssec
+        in_flight = {}
+        while todo or in_flight:
+            while todo and len(in_flight) < max_in_flight:
+                name = todo.popleft()
+                msg = dns.message.make_query(name,
+                                             rdtype,
+                                             payload=30000,
+                                             want_dnssec=with_dnssec,
+                                             flags=flags)
+                qry = self.new_query(msg,
+                                     mx_only=mx_only,
+                                     include_raw=with_dnssec)
+                qry["name"] = name
+                self.new_many_id(qry, in_flight)
+                self.send_next(sock, qry)
 
-            self.expiry += int(self.expiry / 2) if self.expiry > 2 else 1
-            self.tries += 1
+            now = time.monotonic()
+            wait = min(qry["timeout"] for qry in in_flight.values()) - now
+            rlist, _, _ = select.select([sock], [], [], max(wait, 0))
+            answered = []
+            truncated = {}
+            while len(rlist) > 0:
+                reply, (addr, _) = sock.recvfrom(DNS_MAX_RESP)
+                qry = in_flight.get(reply[:2])
+                if qry is not None and self.match_id(qry, reply, addr):
+                    self.query_answered(qry, addr)
+                    del in_flight[reply[:2]]
+                    if self.needs_tcp(qry, reply):
+                        truncated.setdefault(addr, []).append(qry)
+                    else:
+                        answered.append((qry, reply, addr))
+                rlist, _, _ = select.select([sock], [], [], 0)
 
-        return None
+            for addr, qrys in truncated.items():
+                try:
+                    replies = self.ask_tcp(addr,
+                                           [qry["question"] for qry in qrys])
+                except OSError as e:
+                    log.debug(f"DNS TCP error: {e}")
+                    replies = [None] * len(qrys)
+                answered.extend(zip(qrys, replies, [addr] * len(qrys)))
 
-    def ask_in_tcp(self, addr):
-        sock = socket.socket()
-        sock.setblocking(True)
-        sock.connect((addr, 53))
-        sock.send(len(self.question).to_bytes(2, "big") + self.question)
-        sock.settimeout(5)
-        reply = bytes()
-        target_length = None
-        while target_length is None or len(reply) < target_length:
-            try:
-                reply = reply + sock.recv(2000)
-                if target_length is None and len(reply) >= 2:
-                    target_length = reply[0] * 256 + reply[1] + 2
-            except socket.timeout:
-                sock.close()
-                return reply[2:]
-            sock.settimeout(0.2)
-        sock.close()
-        return reply[2:]
+            for qry, reply, addr in answered:
+                ret = None if reply is None else self.decode_wire(
+                    qry, reply, addr)
+                results[qry["name"]] = ret
+                if self.cache is not None and ret is not None:
+                    self.cache.put((qry["name"].rstrip(".").lower(), rdtype,
+                                    flags, with_dnssec, cache_tag), ret)
+
+            now = time.monotonic()
+            for qryid in [
+                    i for i, q in in_flight.items() if q["timeout"] <= now
+            ]:
+                qry = in_flight[qryid]
+                if self.query_timed_out(qry):
+                    del in_flight[qryid]
+                    results[qry["name"]] = None
+                else:
+                    self.send_next(sock, qry)
+
+    def new_many_id(self, qry, in_flight):
+        """ give {qry} a query id not already in flight """
+        while True:
+            qryid = os.urandom(2)
+            if qryid != b"\0\0" and qryid not in in_flight:
+                break
+        qry["question"][0] = qryid[0]
+        qry["question"][1] = qryid[1]
+        in_flight[qryid] = qry
 
-    def json_record(self, rr, i):
+    def json_record(self, rr, i, include_raw=False):
         ret = {
             "name": rr.name.to_text(),
             "data": i.to_text(),
@@ -228,21 +862,21 @@ class Resolver:
             "type": rr.rdtype,
             "typename": dns.rdatatype.to_text(rr.rdtype)
         }
-        if self.include_raw:
+        if include_raw:
             ret["rdata"] = base64.b64encode(i.to_wire()).decode("utf8")
         return ret
 
-    def decode_reply(self):
+    def decode_reply(self, decoded_resp, include_raw=False):
         """ decode binary {message} in DNS format to dictionary in DoH fmt """
-        if (self.decoded_resp.flags & DNS_FLAGS["QR"]) == 0:
+        if (decoded_resp.flags & DNS_FLAGS["QR"]) == 0:
             return None  # REPLY flag not set
 
         out = {}
 
         for flag in DNS_FLAGS:
-            out[flag] = (self.decoded_resp.flags & DNS_FLAGS[flag]) != 0
+            out[flag] = (decoded_resp.flags & DNS_FLAGS[flag]) != 0
 
-        rcode = self.decoded_resp.rcode()
+        rcode = decoded_resp.rcode()
         out["Status"] = rcode
         if rcode in STATUS_NAME:
             out["Status Name"] = STATUS_NAME[rcode]
@@ -252,24 +886,289 @@ class Resolver:
             "TTL": rr.ttl,
             "type": rr.rdtype,
             "typename": dns.rdatatype.to_text(rr.rdtype)
-        } for rr in self.decoded_resp.question]
+        } for rr in decoded_resp.question]
 
         out["Answer"] = [
-            self.json_record(rr, i) for rr in self.decoded_resp.answer
+            self.json_record(rr, i, include_raw) for rr in decoded_resp.answer
             for i in rr
         ]
         out["Authority"] = [
-            self.json_record(rr, i) for rr in self.decoded_resp.authority
-            for i in rr
+            self.json_record(rr, i, include_raw)
+            for rr in decoded_resp.authority for i in rr
         ]
         out["Additional"] = [
-            self.json_record(rr, i) for rr in self.decoded_resp.additional
-            for i in rr
+            self.json_record(rr, i, include_raw)
+            for rr in decoded_resp.additional for i in rr
         ]
 
         return out
 
 
+shared_lock = threading.Lock()
+shared_resolver = None
+
+
+def get_shared_resolver(cache_size=CACHE_MAX_SIZE, shared_path=None):
+    """ one cached Resolver per process, safe to use from any thread.
+        With {shared_path} its cache is backed by a <SharedDnsCache>, if the directory exists """
+    global shared_resolver
+    with shared_lock:
+        if shared_resolver is None:
+            shared = None
+            if shared_path is not None and os.path.isdir(
+                    os.path.dirname(shared_path)):
+                shared = SharedDnsCache(shared_path)
+            shared_resolver = Resolver(cache=DnsCache(cache_size, shared))
+        return shared_resolver
+
+
+class StubServer:
+    """ local DNS server for benchmarks, answers every query with one MX after {delay} secs
+        with {truncate} UDP answers are empty with TC set, so the client has to use TCP """
+
+    def __init__(self,
+                 delay=0.02,
+                 addr="127.0.0.1",
+                 port=0,
+                 drop=False,
+                 truncate=False):
+        self.delay = delay
+        self.drop = drop
+        self.truncate = truncate
+        self.tcp_conns = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((addr, port))
+        self.port = self.sock.getsockname()[1]
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind((addr, self.port))
+        self.tcp_sock.listen(50)
+        threading.Thread(target=self.serve, daemon=True).start()
+        threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+    def answer(self, query, truncate=False):
+        msg = dns.message.from_wire(query)
+        resp = dns.message.make_response(msg)
+        if truncate:
+            resp.flags |= DNS_FLAGS["TC"]
+            return resp.to_wire()
+        name = msg.question[0].name
+        resp.answer.append(
+            dns.rrset.from_text(name, 300, "IN", "MX",
+                                "10 mx." + name.to_text()))
+        return resp.to_wire()
+
+    def serve(self):
+        while True:
+            query, addr = self.sock.recvfrom(DNS_MAX_RESP)
+            if self.drop:
+                continue
+            threading.Timer(self.delay, self.sock.sendto,
+                            (self.answer(query, self.truncate), addr)).start()
+
+    def serve_tcp(self):
+        while True:
+            conn, __ = self.tcp_sock.accept()
+            self.tcp_conns += 1
+            threading.Thread(target=self.serve_conn,
+                             args=(conn, ),
+                             daemon=True).start()
+
+    def serve_conn(self, conn):
+        with conn, conn.makefile("rb") as fd:
+            while len(head := fd.read(2)) == 2:
+                query = fd.read(int.from_bytes(head, "big"))
+                reply = self.answer(query)
+                conn.sendall(len(reply).to_bytes(2, "big") + reply)
+
+
+def bench_decode(count=5000):
+    """ DoH style decode + text split as check_mx_match used to do, vs decode_mx """
+    msg = dns.message.make_query("example.hns", "MX")
+    resp = dns.message.make_response(msg)
+    resp.answer.append(
+        dns.rrset.from_text("example.hns.", 300, "IN", "MX",
+                            "10 abcdefghijklmnop.webmail.example."))
+    resp.authority.append(
+        dns.rrset.from_text("example.hns.", 300, "IN", "NS",
+                            "ns1.example.hns.", "ns2.example.hns."))
+    resp.additional.append(
+        dns.rrset.from_text("ns1.example.hns.", 300, "IN", "A", "192.0.2.1"))
+    wire = resp.to_wire()
+    res = Resolver(["127.0.0.1"])
+
+    def doh_path():
+        ret = res.decode_reply(dns.message.from_wire(wire))
+        return ret["Answer"][0]["data"].split()[1].rstrip(".").lower()
+
+    def mx_path():
+        return decode_mx(wire).mx[0][1]
+
+    assert doh_path() == mx_path()
+    doh_time = timeit.timeit(doh_path, number=count)
+    mx_time = timeit.timeit(mx_path, number=count)
+    print(f"decode {count} MX replies -> DoH {doh_time:.3f}s, " +
+          f"decode_mx {mx_time:.3f}s, x{doh_time / mx_time:.1f} faster")
+
+
+def run_bench(count=200):
+    """ compare {count} serial lookups with resolv_many against a local stub server """
+    bench_decode()
+    bench_tcp()
+    bench_shared()
+
+    stub = StubServer()
+    res = Resolver(["127.0.0.1"], port=stub.port)
+    names = [f"bench-{x}.example" for x in range(0, count)]
+
+    start = time.perf_counter()
+    serial = {name: res.resolv(name, "mx") for name in names}
+    serial_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    many = res.resolv_many(names, "mx")
+    many_time = time.perf_counter() - start
+
+    print(f"{count} names, {stub.delay * 1000:.0f}ms per answer")
+    print(f"serial -> {serial_time:.3f}s, " +
+          f"{len([r for r in serial.values() if r is not None])} answers")
+    print(f"resolv_many -> {many_time:.3f}s, " +
+          f"{len([r for r in many.values() if r is not None])} answers, " +
+          f"x{serial_time / many_time:.1f} faster")
+
+    dead = StubServer(addr="127.0.0.2", port=stub.port, drop=True)
+    res = Resolver(["127.0.0.2", "127.0.0.1"], port=stub.port)
+    start = time.perf_counter()
+    for name in names[:50]:
+        res.resolv(name, "mx")
+    print("50 serial, first server dead -> " +
+          f"{time.perf_counter() - start:.3f}s")
+    for svr, stats in res.server_info().items():
+        print(f"  {svr} -> {stats}")
+    dead.sock.close()
+
+
+def bench_shared_child(path, port, names, results):
+    """ a fresh process with an empty in-process cache, as a second gunicorn worker would be """
+    res = Resolver(["127.0.0.1"],
+                   cache=DnsCache(shared=SharedDnsCache(path)),
+                   port=port)
+    start = time.perf_counter()
+    for name in names:
+        res.resolv_mx(name)
+    results.put((time.perf_counter() - start, res.cache.info()))
+
+
+def bench_shared(count=200):
+    """ one process resolves {count} names, then another looks them up again """
+    stub = StubServer()
+    names = [f"shared-{x}.example" for x in range(0, count)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "cache.db")
+        res = Resolver(["127.0.0.1"],
+                       cache=DnsCache(shared=SharedDnsCache(path)),
+                       port=stub.port)
+        start = time.perf_counter()
+        for name in names:
+            res.resolv_mx(name)
+        print(f"shared cache, {count} MX in first process -> " +
+              f"{time.perf_counter() - start:.3f}s")
+
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=bench_shared_child,
+                                        args=(path, stub.port, names, results))
+        child.start()
+        taken, info = results.get()
+        child.join()
+        print(f"shared cache, same {count} in second process -> " +
+              f"{taken:.3f}s, {info}")
+
+
+def bench_tcp(count=200):
+    """ truncated answers, a new TCP connection per query vs the pipelined pool """
+    stub = StubServer(delay=0, truncate=True)
+    res = Resolver(["127.0.0.1"], port=stub.port)
+    names = [f"tcp-{x}.example" for x in range(0, count)]
+    questions = [
+        bytearray(dns.message.make_query(name, "MX").to_wire())
+        for name in names
+    ]
+
+    ways = {
+        "new connection each":
+        lambda: [
+            TcpConn("127.0.0.1", stub.port).ask([question])[0]
+            for question in questions
+        ],
+        "pooled connection":
+        lambda:
+        [res.ask_in_tcp("127.0.0.1", question) for question in questions],
+        "pooled & pipelined":
+        lambda: res.ask_tcp("127.0.0.1", questions)
+    }
+    for desc, func in ways.items():
+        conns = stub.tcp_conns
+        start = time.perf_counter()
+        replies = func()
+        print(f"{count} TCP queries, {desc} -> " +
+              f"{time.perf_counter() - start:.3f}s, " +
+              f"{len([r for r in replies if decode_mx(r).mx])} answers, " +
+              f"{stub.tcp_conns - conns} connections")
+
+    start = time.perf_counter()
+    many = res.resolv_many(names, "mx", mx_only=True, use_cache=False)
+    print("resolv_many, all truncated -> " +
+          f"{time.perf_counter() - start:.3f}s, " +
+          f"{len([r for r in many.values() if r is not None and r.mx])} " +
+          "answers")
+
+
+def stress_worker(res, thread_num, count, errors):
+    """ mix of lookup types, each answer must be for the name this thread asked """
+    names = [f"stress-{thread_num}-{x}.example" for x in range(0, count)]
+    for x, name in enumerate(names):
+        if x % 3 == 0:
+            ret = res.resolv(name, "mx", use_cache=False)
+            ok = ret is not None and ret["Answer"][0][
+                "data"] == f"10 mx.{name}."
+        elif x % 3 == 1:
+            ret = res.resolv_mx(name, use_cache=(x % 2 == 0))
+            ok = ret is not None and ret.mx == ((10, f"mx.{name}"), )
+        else:
+            batch = names[x:x + 10]
+            ret = res.resolv_many(batch, "mx", mx_only=True)
+            ok = all(ret[each] is not None and ret[each].mx == (
+                (10, f"mx.{each}"), ) for each in batch)
+        if not ok:
+            errors.append((name, ret))
+
+
+def run_stress(threads=32, count=100):
+    """ drive one shared Resolver from {threads} threads at once """
+    stub = StubServer(delay=0.005)
+    res = Resolver(["127.0.0.1"], cache=DnsCache(), port=stub.port)
+    errors = []
+    workers = [
+        threading.Thread(target=stress_worker, args=(res, x, count, errors))
+        for x in range(0, threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    print(
+        f"{threads} threads x {count} lookups -> " +
+        f"{time.perf_counter() - start:.3f}s, {len(errors)} wrong answers, " +
+        f"{len(res.sock_pool)} pooled sockets")
+    print("Cache:", res.cache.info())
+    for svr, stats in res.server_info().items():
+        print(f"  {svr} -> {stats}")
+    for name, ret in errors[:5]:
+        print(f"ERROR: {name} -> {ret}")
+
+
 def main():
     """ main """
     log.init("Resolver test run", with_debug=True, to_syslog=False)
@@ -303,23 +1202,44 @@ def main():
                         "--no-recursion",
                         help="Make authritative, not recursive query (RD=0)",
                         action="store_true")
+    parser.add_argument("-C",
+                        "--cache",
+                        default=False,
+                        help="Query twice through a cache & show its stats",
+                        action="store_true")
+    parser.add_argument("-B",
+                        "--bench",
+                        default=False,
+                        help="Benchmark serial vs concurrent lookups",
+                        action="store_true")
+    parser.add_argument("-S",
+                        "--stress",
+                        default=False,
+                        help="Share one Resolver between many threads",
+                        action="store_true")
     args = parser.parse_args()
 
-    if not validation.is_valid_account(args.name):
+    if args.bench:
+        run_bench()
+    elif args.stress:
+        run_stress()
+    elif not validation.is_valid_account(args.name):
         print(f"ERROR: '{args.name}' is an invalid host name")
     else:
-        res = Resolver()
-        flags = 0 if args.no_recursion else DNS_FLAGS["RD"]
         servers = args.servers.split(",") if args.servers else None
-        print(
-            json.dumps(res.resolv(args.name,
-                                  args.rdtype,
-                                  with_dnssec=args.with_dnssec,
-                                  include_raw=args.include_raw,
-                                  force_tcp=args.force_tcp,
-                                  servers=servers,
-                                  flags=flags),
-                       indent=2))
+        res = Resolver(servers, cache=DnsCache() if args.cache else None)
+        flags = 0 if args.no_recursion else DNS_FLAGS["RD"]
+        for x in range(0, 2 if args.cache else 1):
+            print(
+                json.dumps(res.resolv(args.name,
+                                      args.rdtype,
+                                      with_dnssec=args.with_dnssec,
+                                      include_raw=args.include_raw,
+                                      force_tcp=args.force_tcp,
+                                      flags=flags),
+                           indent=2))
+        if args.cache:
+            print("Cache:", res.cache.info())
 
 
 if __name__ == "__main__":
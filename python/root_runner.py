@@ -6,15 +6,18 @@ import os
 import time
 import json
 import shutil
+import tempfile
 import argparse
 import subprocess
 
 import executor
 import misc
+import postfix_maps
 from log import this_log as log
 from policy import this_policy as policy
 
 POSTFIX_UNIX_ID = 151
+POSTMAP = "/usr/sbin/postmap"
 
 
 def get_gid(grp):
@@ -56,17 +59,93 @@ def make_home_dir(data):
     return True
 
 
-def install_system_files(data):
-    for file in ["transport", "local", "virtual"]:
-        pfx = os.path.join(policy.BASE, "postfix", "data", file)
+def run_postmap(args, stdin=None):
+    """ True if postmap worked. A delete that found none of its keys exits 1, but says nothing,
+        which is fine, errors also exit 1 but give a reason """
+    ret = subprocess.run([POSTMAP] + args,
+                         input=stdin,
+                         text=True,
+                         stderr=subprocess.PIPE,
+                         stdout=subprocess.DEVNULL)
+    if ret.returncode == 0:
+        return True
+    if "-d" in args and ret.returncode == 1 and len(ret.stderr.strip()) == 0:
+        return True
+    log.log(f"ERROR: postmap {args} failed: {ret.stderr.strip()}")
+    return False
+
+
+def fake_postmap(args, stdin=None):
+    """ for tests, the table is kept as JSON in the file postmap would make """
+    pfx = args[-1]
+    if "-i" in args or "-d" in args:
+        with open(pfx + ".lmdb", "r") as fd:
+            entries = json.load(fd)
+    else:
+        entries = postfix_maps.read_map(pfx)
+    if "-d" in args:
+        for key in stdin.split():
+            entries.pop(key, None)
+    if "-i" in args:
+        for line in stdin.splitlines():
+            key, value = line.split(maxsplit=1)
+            entries[key] = value
+    with open(pfx + ".lmdb", "w") as fd:
+        json.dump(entries, fd)
+    return True
+
+
+postmap = run_postmap
+
+
+def install_map(pfx, delta=None):
+    """ apply {delta} to table {pfx} & its source, else rebuild it from the source """
+    if delta is not None:
+        entries = postfix_maps.apply_delta(postfix_maps.read_map(pfx), delta)
+        postfix_maps.write_map(pfx + ".tmp", entries)
+        os.chown(pfx + ".tmp", POSTFIX_UNIX_ID, POSTFIX_UNIX_ID)
+        os.replace(pfx + ".tmp", pfx)
+
+    if delta is None or not os.path.isfile(pfx + ".lmdb"):
+        ok = postmap([pfx])
+    else:
+        removes = "".join([f"{key}\n" for key in delta["remove"]])
+        adds = "".join(
+            [f"{key} {value}\n" for key, value in delta["add"].items()])
+        ok = not removes or postmap(["-d", "-", pfx], removes)
+        ok = ok and (not adds or postmap(["-r", "-i", pfx], adds))
+        if not ok:
+            log.log(f"ERROR: postmap delta failed for '{pfx}', rebuilding")
+            ok = postmap([pfx])
+
+    if os.path.isfile(pfx + ".lmdb"):
+        os.chown(pfx + ".lmdb", POSTFIX_UNIX_ID, POSTFIX_UNIX_ID)
+    return ok
+
+
+def install_mail_maps():
+    """ whole tables first, they replace any earlier deltas, then the deltas in order """
+    for file in postfix_maps.MAPS:
+        pfx = postfix_maps.map_file(file)
         new = pfx + ".new"
         if os.path.isfile(new):
             os.chown(new, POSTFIX_UNIX_ID, POSTFIX_UNIX_ID)
             os.replace(new, pfx)
-            subprocess.run(["/usr/sbin/postmap", pfx],
-                           stderr=subprocess.DEVNULL,
-                           stdout=subprocess.DEVNULL)
-            os.chown(pfx + ".lmdb", POSTFIX_UNIX_ID, POSTFIX_UNIX_ID)
+            install_map(pfx)
+
+    for path in postfix_maps.delta_files():
+        if (deltas := postfix_maps.load_delta(path)) is None:
+            log.log(f"ERROR: postfix delta '{path}' could not be read")
+            deltas = {}
+        for file, delta in deltas.items():
+            if file in postfix_maps.MAPS:
+                install_map(postfix_maps.map_file(file), delta)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def install_system_files(data):
+    install_mail_maps()
 
     for file in ["passwd", "shadow", "group"]:
         src = f"/run/{file}.new"
@@ -100,9 +179,10 @@ ROOT_CMDS = {
 def runner(to_syslog):
     log.init("ROOT backend", with_debug=misc.debug_mode(), to_syslog=to_syslog)
     log.log("ROOT backend running")
+    queue = executor.CommandQueue("root")
     while True:
-        if (file := executor.find_oldest_cmd("root")) is None:
-            time.sleep(1)
+        if (file := queue.next_cmd()) is None:
+            queue.wait()
         else:
             with open(file, "r") as fd:
                 cmd_data = json.load(fd)
@@ -118,7 +198,55 @@ def runner(to_syslog):
                     time.sleep(5)
 
 
+def test_mail_maps():
+    """ whole tables then deltas, each table should match its source """
+    save = policy.BASE
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy.BASE = tmpdir
+        os.makedirs(postfix_maps.map_dir())
+        tables = {
+            file: {
+                f"{file}{num}.example": "OK"
+                for num in range(0, 100)
+            }
+            for file in postfix_maps.MAPS
+        }
+        for file, entries in tables.items():
+            postfix_maps.write_map(
+                postfix_maps.map_file(file) + ".new", entries)
+        install_mail_maps()
+
+        for num in range(0, 10):
+            new = {file: dict(entries) for file, entries in tables.items()}
+            new["local"].pop(f"local{num}.example")
+            new["virtual"][f"added{num}.example"] = "user"
+            new["transport"][f"transport{num}.example"] = "smtp: [relay]"
+            postfix_maps.save_delta({
+                file:
+                postfix_maps.diff_map(tables[file], new[file])
+                for file in postfix_maps.MAPS
+            })
+            tables = new
+        install_mail_maps()
+
+        for file, entries in tables.items():
+            pfx = postfix_maps.map_file(file)
+            with open(pfx + ".lmdb", "r") as fd:
+                ok = json.load(fd) == entries == postfix_maps.read_map(pfx)
+            print(f"{file} -> {'OK' if ok else 'FAILED'}, " +
+                  f"{len(entries)} entries")
+        print("deltas left ->", len(postfix_maps.delta_files()))
+    policy.BASE = save
+
+
 def run_tests():
+    global postmap
+    save = postmap
+    postmap = fake_postmap
+    try:
+        test_mail_maps()
+    finally:
+        postmap = save
     install_system_files(None)
     print(PASSWD_FILE_PERMS)
     print(get_gid("shadow"))
@@ -8,6 +8,7 @@ import flask
 from log import this_log as log
 import users
 import misc
+import uconfig
 from policy import this_policy as policy
 
 HTML_CODE_ERR = 299
@@ -81,6 +82,9 @@ class WebuiReq:
         return self.response({"error": data}, HTML_CODE_ERR)
 
     def send_user_data(self):
+        """ the only place events are shown, so the only place they are read """
+        if isinstance(this_user := self.user_data.get("user", None), dict):
+            this_user["events"] = uconfig.load_events(this_user["user"])
         return self.response(self.user_data)
 
     def response(self, data, code=HTML_CODE_OK):
@@ -190,6 +194,19 @@ def users_password():
     return req.response("OK")
 
 
+@application.route('/wmapi/users/recheck', methods=['POST'])
+def users_recheck():
+    req = WebuiReq()
+    if not req.is_logged_in:
+        return req.abort(NOT_LOGGED_IN)
+
+    ok, reply = users.recheck_domains(req.user)
+    if not ok:
+        return req.abort(reply)
+
+    return req.response("OK")
+
+
 @application.route('/wmapi/users/login', methods=['POST'])
 def users_login():
     req = WebuiReq()
@@ -0,0 +1,195 @@
+#! /usr/bin/python3
+# (c) Copyright 2019-2025, James Stevens ... see LICENSE for details
+# Alternative license arrangements possible, contact me for more information
+""" local index of the TLDs in the Handshake root zone, so registration doesn't need DNS to check a TLD """
+
+import os
+import sys
+import mmap
+import time
+import random
+import string
+import tempfile
+import argparse
+import threading
+import dns.query
+
+from policy import this_policy as policy
+from log import this_log as log
+
+
+def find_line(data, key):
+    """ binary search {data}, sorted lines of bytes, for the line {key} """
+    low, high = 0, len(data)
+    while low < high:
+        mid = (low + high) // 2
+        start = data.rfind(b"\n", 0, mid) + 1
+        if (end := data.find(b"\n", start)) < 0:
+            end = len(data)
+        line = data[start:end]
+        if line == key:
+            return True
+        if line < key:
+            low = end + 1
+        else:
+            high = start
+    return False
+
+
+def clean_name(name):
+    """ {name} as a TLD, or None if it isn't one """
+    name = name.rstrip(".").lower()
+    if len(name) == 0 or "." in name or name == "@":
+        return None
+    return name
+
+
+def names_from_zone(fd):
+    """ TLDs from a text dump of the root zone, anything that owns a record exists """
+    for line in fd:
+        if len(line) == 0 or line[0] in " \t\n;$":
+            continue
+        if (name := clean_name(line.split(maxsplit=1)[0])) is not None:
+            yield name
+
+
+def names_from_axfr(server, port=53):
+    """ TLDs from a zone transfer of the root zone from {server} """
+    for msg in dns.query.xfr(server, ".", port=port, lifetime=600):
+        for rrset in msg.answer:
+            if (name := clean_name(rrset.name.to_text())) is not None:
+                yield name
+
+
+def build(names, path):
+    """ write the sorted unique {names} to {path}, atomically """
+    tlds = sorted({name.encode("utf-8") for name in names})
+    with tempfile.NamedTemporaryFile("wb",
+                                     dir=os.path.dirname(path),
+                                     delete=False) as fd:
+        fd.write(b"\n".join(tlds) + b"\n")
+    os.chmod(fd.name, 0o644)
+    os.replace(fd.name, path)
+    return len(tlds)
+
+
+class TldIndex:
+    """ sorted file of TLDs, mapped in on first use & re-mapped when the file is replaced """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.stat = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ (re)map the file if its changed, returns the mapped data or None if there's no usable index.
+            An old map is left for the garbage collector, as another thread could still be using it """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if time.time() - stat.st_mtime > policy.get("tld_index_max_age",
+                                                    86400 * 7):
+            return None
+
+        with self.lock:
+            if self.stat is None or (stat.st_ino, stat.st_mtime_ns) != (
+                    self.stat.st_ino, self.stat.st_mtime_ns):
+                self.stat = stat
+                self.data = None
+                if stat.st_size > 0:
+                    with open(self.path, "rb") as fd:
+                        self.data = mmap.mmap(fd.fileno(),
+                                              0,
+                                              access=mmap.ACCESS_READ)
+                    log.debug(f"TLD index '{self.path}' loaded, " +
+                              f"{stat.st_size} bytes")
+            return self.data
+
+    def exists(self, tld):
+        """ True if {tld} is known to exist, None if we don't know, as the index could be out of date """
+        if (data := self.load()) is None:
+            return None
+        key = tld.rstrip(".").lower().encode("utf-8")
+        return True if find_line(data, key) else None
+
+
+this_index = TldIndex(policy.TLD_INDEX_FILE)
+
+
+def refresh():
+    """ rebuild the index from the root server in the policy, if there is one """
+    if (server := policy.get("tld_index_axfr_server", None)) is None:
+        return None
+    return build(names_from_axfr(server), policy.TLD_INDEX_FILE)
+
+
+def run_bench(count=1000000, lookups=100000):
+    """ build an index of {count} random TLDs & time {lookups} lookups """
+    names = {
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(3,
+                                                                        12)))
+        for __ in range(0, count)
+    }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "tlds")
+        start = time.perf_counter()
+        build(names, path)
+        print(f"build {len(names)} -> {time.perf_counter() - start:.3f}s, " +
+              f"{os.path.getsize(path)} bytes")
+
+        index = TldIndex(path)
+        start = time.perf_counter()
+        index.load()
+        print(f"load -> {(time.perf_counter() - start) * 1000:.3f}ms")
+
+        probe = random.sample(sorted(names), lookups // 2) + [
+            "zz" + name for name in random.sample(sorted(names), lookups // 2)
+        ]
+        start = time.perf_counter()
+        found = len([tld for tld in probe if index.exists(tld)])
+        taken = time.perf_counter() - start
+        print(f"{lookups} lookups -> {taken:.3f}s, " +
+              f"{taken / lookups * 1000000:.2f}us each, {found} found")
+        index.data = None
+
+
+def main():
+    log.init("TLD index", with_debug=True, to_syslog=False)
+    parser = argparse.ArgumentParser(description='Handshake TLD index')
+    parser.add_argument("-z", "--zone", help="Build from a root zone dump")
+    parser.add_argument("-a",
+                        "--axfr",
+                        help="Build by zone transfer from this server")
+    parser.add_argument("-r",
+                        "--refresh",
+                        default=False,
+                        help="Rebuild using the server in the policy",
+                        action="store_true")
+    parser.add_argument("-c", "--check", help="Check if a TLD is in the index")
+    parser.add_argument("-B",
+                        "--bench",
+                        default=False,
+                        help="Benchmark build & lookups",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.bench:
+        run_bench()
+    elif args.zone:
+        with open(args.zone, "r") as fd:
+            print(build(names_from_zone(fd), policy.TLD_INDEX_FILE), "TLDs")
+    elif args.axfr:
+        print(build(names_from_axfr(args.axfr), policy.TLD_INDEX_FILE), "TLDs")
+    elif args.refresh:
+        if (ret := refresh()) is not None:
+            log.log(f"TLD index refreshed, {ret} TLDs")
+    elif args.check:
+        print(this_index.exists(args.check))
+    else:
+        parser.print_help(sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,32 @@
 # Alternative license arrangements possible, contact me for more information
 
 import os
-import filelock
+import sys
+import time
 import json
+import random
+import fcntl
+import sqlite3
+import subprocess
+import argparse
+import tempfile
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+import filelock
 
 import misc
 from policy import this_policy as policy
 
+INDEXED_FIELDS = ["email", "uid", "domain", "identity"]
+
+USER_CACHE_SIZE = 1000
+EVENTS_FILE_SIZE = 32768
+EVENTS_MAX = 200
+UPDATE_TRIES = 10
+LOAD_WORKERS = 1
+
 
 def calc_hash(user):
     if user == policy.get("manager_account"):
@@ -22,17 +42,23 @@ def calc_hash(user):
     return [ret[:2], ret[2:]]
 
 
-def user_file_name(user, with_make_dir=False, with_lock_name=False):
+def user_file_name(user,
+                   with_make_dir=False,
+                   with_lock_name=False,
+                   user_dir=None):
+    if user_dir is None:
+        user_dir = policy.USER_DIR
     this_hash = calc_hash(user)
     if with_make_dir:
-        d = policy.USER_DIR
+        d = user_dir
         for dir in [this_hash[0], this_hash[1]]:
             d = os.path.join(d, dir)
             if not os.path.isdir(d):
                 os.mkdir(d, mode=0o755)
-    path = os.path.join(policy.USER_DIR, this_hash[0], this_hash[1])
+    path = os.path.join(user_dir, this_hash[0], this_hash[1])
     if with_lock_name:
-        return os.path.join(path, user + ".json"), os.path.join(path, ".lock")
+        return os.path.join(path, user + ".json"), os.path.join(
+            path, user + ".lock")
     else:
         return os.path.join(path, user + ".json")
 
@@ -45,81 +71,943 @@ def return_user(js, user):
     return ret_user
 
 
-def load(user, with_events=True):
-    user_file = user_file_name(user)
-    if not os.path.isfile(user_file):
-        return None, "File not found"
+def finish_load(user, js, with_utf8=True):
+    js["user"] = user
+    if with_utf8:
+        names = [user] + list(js.get("domains", {}))
+        js["utf8"] = dict(zip(names, misc.puny_to_utf8_many(names)))
+    return True, js
+
 
-    with open(user_file, "r") as fd:
-        js = json.load(fd)
+def apply_update(js, data):
+    """ merge {data} into user record {js}, None removes an item.
+        Returns any events still held in the record, so they can be moved to the events log """
+    for item in data:
+        this_data = data[item]
+        if this_data is None:
+            if item in js:
+                del js[item]
+        else:
+            js[item] = this_data
+    js["amended_dt"] = misc.now()
+    js["version"] = js.get("version", 0) + 1
+    return js.pop("events", [])
+
+
+def bare_record(user, js):
+    """ user {js} as bulk loads want it, without their events or utf8 name """
+    js = finish_load(user, js, False)[1]
+    js.pop("events", None)
+    return js
 
-    js["user"] = user
-    js["utf8"] = {user: misc.puny_to_utf8(user)}
-    for dom in js.get("domains", {}):
-        js["utf8"][dom] = misc.puny_to_utf8(dom)
 
-    if not with_events and "events" in js:
-        del js["events"]
+def load_files(files):
+    """ load each (user, file) in {files}, skipping any removed since we found them,
+        as {user: (stamp, record)}. Only the webui shows the utf8 names, so they are not decoded """
+    loaded = {}
+    for user, file in files:
+        try:
+            with open(file, "rb") as fd:
+                stamp = fd_stamp(fd)
+                loaded[user] = (stamp, bare_record(user,
+                                                   json.loads(fd.read())))
+        except FileNotFoundError:
+            continue
+    return loaded
+
+
+def updated(user, js, old_events):
+    """ reply for a successful update, any old events go back to be moved to the log """
+    js["user"] = user
+    if old_events:
+        js["events"] = old_events
     return True, js
 
 
-def update(user, data, with_events=False):
-    user_file, lock_file = user_file_name(user, with_lock_name=True)
-    if not os.path.isfile(user_file):
+def events_file_name(user, with_make_dir=False):
+    return os.path.splitext(user_file_name(user, with_make_dir))[0] + ".events"
+
+
+def split_events(data):
+    """ copy of {data} without its events & the events, as a list, each with a time """
+    data = dict(data)
+    events = data.pop("events", None)
+    if events is None:
+        events = []
+    elif isinstance(events, dict):
+        events = [events]
+    now = misc.now()
+    for each_event in events:
+        if "when_dt" not in each_event:
+            each_event["when_dt"] = now
+    return data, events
+
+
+def append_events(user, events):
+    """ add {events} to the user's log with one O_APPEND write, rotating it once it gets too big """
+    if not events:
+        return
+    lines = "".join(json.dumps(each_event) + "\n" for each_event in events)
+    file = events_file_name(user, True)
+    fd = os.open(file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines.encode("utf-8"))
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+    if size > policy.get("events_file_size", EVENTS_FILE_SIZE):
+        __, lock_file = user_file_name(user, with_lock_name=True)
+        with UserLock(lock_file):
+            if os.path.getsize(file) > policy.get("events_file_size",
+                                                  EVENTS_FILE_SIZE):
+                os.replace(file, file + ".old")
+
+
+def load_events(user):
+    """ the user's most recent events, oldest first """
+    file = events_file_name(user)
+    events = []
+    for this_file in [file + ".old", file]:
+        try:
+            with open(this_file, "r") as fd:
+                for line in fd:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return events[-policy.get("events_max", EVENTS_MAX):]
+
+
+def remove_events(user):
+    file = events_file_name(user)
+    for this_file in [file + ".old", file]:
+        if os.path.isfile(this_file):
+            os.remove(this_file)
+
+
+def index_values(js):
+    """ the values user record {js} can be found by """
+    return {
+        "email": [js["email"]] if js.get("email", None) else [],
+        "uid": [js["uid"]] if js.get("uid", None) is not None else [],
+        "domain": list(js.get("domains", {})),
+        "identity": list(js.get("identities", []))
+    }
+
+
+def clone(js):
+    """ copy of a parsed JSON item, much quicker than copy.deepcopy """
+    if isinstance(js, dict):
+        return {key: clone(val) for key, val in js.items()}
+    if isinstance(js, list):
+        return [clone(val) for val in js]
+    return js
+
+
+def clone_user(js):
+    """ events are never changed once written, so can be shared """
+    return {
+        key: list(val) if key == "events" else clone(val)
+        for key, val in js.items()
+    }
+
+
+class UserCache:
+    """ size bounded LRU cache of loaded users, each kept with the stat of its
+        file so a changed file, from any process, is never served """
+
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evicted": 0}
+
+    def get(self, user, stamp):
+        with self.lock:
+            entry = self.entries.get(user, None)
+            if entry is not None and entry[0] != stamp:
+                del self.entries[user]
+                self.stats["stale"] += 1
+                entry = None
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(user)
+            self.stats["hits"] += 1
+        return clone_user(entry[1])
+
+    def put(self, user, stamp, js):
+        entry = (stamp, clone_user(js))
+        with self.lock:
+            self.entries[user] = entry
+            self.entries.move_to_end(user)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def forget(self, user):
+        with self.lock:
+            self.entries.pop(user, None)
+
+
+def file_stamp(file):
+    """ what identifies this version of {file}, or None if there isn't one """
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
         return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def fd_stamp(fd):
+    stat = os.fstat(fd.fileno())
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class UserLock:
+    """ exclusive flock on a user's {lock_file}, the same lock filelock takes but much cheaper to get """
+
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.fd = None
+
+    def __enter__(self):
+        """ the file is removed with the user, while locked, so check the one we got is still there """
+        while True:
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.lock_file).st_ino:
+                    self.fd = fd
+                    return self
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+        self.fd = None
+
+
+def write_new(user_file, js):
+    """ write {js} next to {user_file}, in a file of its own, ready to replace it """
+    new_file = f"{user_file}.{os.getpid()}.{threading.get_ident()}.new"
+    with open(new_file, "w") as fd:
+        json.dump(js, fd, indent=2)
+    return new_file
 
-    if data is None and os.path.isfile(user_file):
-        os.remove(user_file)
-        return True, None
 
-    with filelock.FileLock(lock_file):
+class FileStore:
+    """ one JSON file per user, in two levels of directories by hash of the name """
+
+    def __init__(self, user_dir=None, cache_size=USER_CACHE_SIZE):
+        self.user_dir = policy.USER_DIR if user_dir is None else user_dir
+        self.cache = UserCache(cache_size) if cache_size > 0 else None
+
+    def file_name(self, user, with_make_dir=False, with_lock_name=False):
+        return user_file_name(user, with_make_dir, with_lock_name,
+                              self.user_dir)
+
+    def load(self, user):
+        """ a stat checks the cached copy, else read the file """
+        user_file = self.file_name(user)
+        if (stamp := file_stamp(user_file)) is None:
+            return None, "File not found"
+
+        if self.cache is not None and (js := self.cache.get(
+                user, stamp)) is not None:
+            return True, js
 
         with open(user_file, "r") as fd:
             js = json.load(fd)
 
-            for item in data:
-                this_data = data[item]
-                if this_data is None:
-                    if item in js:
-                        del js[item]
+        ok, js = finish_load(user, js)
+        if self.cache is not None and file_stamp(user_file) == stamp:
+            self.cache.put(user, stamp, js)
+        return ok, js
+
+    def update(self, user, data):
+        user_file, lock_file = self.file_name(user, with_lock_name=True)
+        if not os.path.isfile(user_file):
+            return False, "User not found"
+
+        self.forget(user)
+        if data is None:
+            self.remove_locked(user_file, lock_file)
+            return True, None
+
+        for __ in range(0, UPDATE_TRIES):
+            if (ret := self.update_cas(user_file, lock_file, data)) is None:
+                return False, "User not found"
+            if ret is not False:
+                return updated(user, *ret)
+            time.sleep(random.random() / 1000)
+
+        return self.update_locked(user, user_file, lock_file, data)
+
+    def update_cas(self, user_file, lock_file, data):
+        """ read & change the user without any lock, then only replace the file if
+            no one else has since. Returns what changed, False if we lost the race or None """
+        try:
+            with open(user_file, "r") as fd:
+                stamp = fd_stamp(fd)
+                js = json.load(fd)
+        except FileNotFoundError:
+            return None
+
+        old_events = apply_update(js, data)
+        new_file = write_new(user_file, js)
+        with UserLock(lock_file):
+            if file_stamp(user_file) == stamp:
+                os.replace(new_file, user_file)
+                return js, old_events
+        os.remove(new_file)
+        return False
+
+    def update_locked(self, user, user_file, lock_file, data):
+        """ after too many lost races, hold the lock throughout """
+        with UserLock(lock_file):
+            if not os.path.isfile(user_file):
+                return False, "User not found"
+            with open(user_file, "r") as fd:
+                js = json.load(fd)
+            old_events = apply_update(js, data)
+            os.replace(write_new(user_file, js), user_file)
+        return updated(user, js, old_events)
+
+    def forget(self, user):
+        if self.cache is not None:
+            self.cache.forget(user)
+
+    def create(self, user, data):
+        self.forget(user)
+        try:
+            with open(self.file_name(user, with_make_dir=True), "x") as fd:
+                json.dump(data, fd, indent=2)
+        except FileExistsError:
+            return False, "User already exists"
+        return True, None
+
+    def exists(self, user):
+        return os.path.isfile(self.file_name(user))
+
+    def remove(self, user):
+        self.forget(user)
+        user_file, lock_file = self.file_name(user, with_lock_name=True)
+        if os.path.isfile(user_file) or os.path.isfile(lock_file):
+            self.remove_locked(user_file, lock_file)
+
+    def remove_locked(self, user_file, lock_file):
+        """ the lock file is only removed while we hold it, see UserLock """
+        with UserLock(lock_file):
+            if os.path.isfile(user_file):
+                os.remove(user_file)
+            os.remove(lock_file)
+
+    def walk(self):
+        """ (user, file) for every user, short hashes leave some files only one level down """
+        files = []
+        dirs = [self.user_dir]
+        while dirs:
+            for entry in os.scandir(dirs.pop()):
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    files.append((entry.name[:-5], entry.path))
+        return files
+
+    def all_users(self):
+        return [user for user, __ in self.walk()]
+
+    def load_all(self,
+                 workers=LOAD_WORKERS,
+                 pool_type=concurrent.futures.ThreadPoolExecutor,
+                 known=None):
+        """ every user as {user: (stamp, record)}, users in {known}, the same shape,
+            are kept if their file is unchanged, the rest are read & parsed by a pool of {workers} """
+        all_users = {}
+        files = self.walk()
+        if known:
+            todo = []
+            for user, file in files:
+                if user in known and known[user][0] == file_stamp(file):
+                    all_users[user] = known[user]
+                else:
+                    todo.append((user, file))
+            files = todo
+
+        if workers <= 1 or len(files) <= 1:
+            all_users.update(load_files(files))
+            return all_users
+
+        size = max(1, len(files) // (workers * 4))
+        chunks = [files[pos:pos + size] for pos in range(0, len(files), size)]
+        with pool_type(workers) as pool:
+            for loaded in pool.map(load_files, chunks):
+                all_users.update(loaded)
+        return all_users
+
+    def find_users(self, field, value):
+        """ no index, so this reads every user """
+        found = []
+        for user in self.all_users():
+            ok, js = self.load(user)
+            if ok and value in index_values(js)[field]:
+                found.append(user)
+        return found
+
+
+class SqliteStore:
+    """ users in an SQLite WAL database, with indexes on the fields in INDEXED_FIELDS """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def db(self):
+        """ sqlite connections can't be shared between threads, so one each """
+        if (conn := getattr(self.local, "conn", None)) is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users
+                    (user TEXT PRIMARY KEY, email TEXT, uid INTEGER, data TEXT NOT NULL)
+                    WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS users_email ON users(email);
+                CREATE INDEX IF NOT EXISTS users_uid ON users(uid);
+                CREATE TABLE IF NOT EXISTS user_domain
+                    (value TEXT, user TEXT, PRIMARY KEY(value, user)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS user_domain_user ON user_domain(user);
+                CREATE TABLE IF NOT EXISTS user_identity
+                    (value TEXT, user TEXT, PRIMARY KEY(value, user)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS user_identity_user ON user_identity(user);
+                """)
+            self.local.conn = conn
+        return conn
+
+    def read(self, conn, user):
+        row = conn.execute("SELECT data FROM users WHERE user = ?",
+                           (user, )).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def write(self, conn, user, js):
+        """ save {js} & its index rows, the caller holds the transaction """
+        values = index_values(js)
+        conn.execute(
+            "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)",
+            (user, js.get("email", None), js.get("uid", None), json.dumps(js)))
+        for field in ["domain", "identity"]:
+            conn.execute(f"DELETE FROM user_{field} WHERE user = ?", (user, ))
+            conn.executemany(
+                f"INSERT OR IGNORE INTO user_{field} VALUES (?, ?)",
+                [(value, user) for value in values[field]])
+
+    def transaction(self, func, *args):
+        """ run {func} in a write transaction, so read-modify-write is atomic across processes """
+        conn = self.db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ret = func(conn, *args)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return ret
+
+    def load(self, user):
+        if (js := self.read(self.db(), user)) is None:
+            return None, "User not found"
+        return finish_load(user, js)
+
+    def update(self, user, data):
+        if data is None:
+            if not self.exists(user):
+                return False, "User not found"
+            self.remove(user)
+            return True, None
+
+        for __ in range(0, UPDATE_TRIES):
+            if (js := self.read(self.db(), user)) is None:
+                return False, "User not found"
+            version = js.get("version", 0)
+            old_events = apply_update(js, data)
+            if self.transaction(self.write_if, user, js, version):
+                return updated(user, js, old_events)
+            time.sleep(random.random() / 1000)
+
+        if (ret := self.transaction(self.update_in, user, data)) is None:
+            return False, "User not found"
+        return updated(user, *ret)
+
+    def write_if(self, conn, user, js, version):
+        """ only save {js} if the user is still at {version}, so the write lock is held briefly """
+        row = conn.execute(
+            "SELECT IFNULL(json_extract(data, '$.version'), 0) FROM users WHERE user = ?",
+            (user, )).fetchone()
+        if row is None or row[0] != version:
+            return False
+        self.write(conn, user, js)
+        return True
+
+    def update_in(self, conn, user, data):
+        """ after too many lost races, read & write in one transaction """
+        if (js := self.read(conn, user)) is None:
+            return None
+        old_events = apply_update(js, data)
+        self.write(conn, user, js)
+        return js, old_events
+
+    def create(self, user, data):
+        return self.transaction(self.create_in, user, data)
+
+    def create_in(self, conn, user, data):
+        if self.read(conn, user) is not None:
+            return False, "User already exists"
+        self.write(conn, user, data)
+        return True, None
+
+    def exists(self, user):
+        return self.db().execute("SELECT 1 FROM users WHERE user = ?",
+                                 (user, )).fetchone() is not None
+
+    def remove(self, user):
+        self.transaction(self.remove_in, user)
+
+    def remove_in(self, conn, user):
+        for table in ["users", "user_domain", "user_identity"]:
+            conn.execute(f"DELETE FROM {table} WHERE user = ?", (user, ))
+
+    def all_users(self):
+        return [row[0] for row in self.db().execute("SELECT user FROM users")]
+
+    def load_all(self, workers=LOAD_WORKERS, pool_type=None, known=None):
+        """ one query is quicker than any pool & there are no stamps to
+            check against {known}, so those are not used """
+        return {
+            user: (None, bare_record(user, json.loads(data)))
+            for user, data in self.db().execute("SELECT user, data FROM users")
+        }
+
+    def find_users(self, field, value):
+        if field in ["email", "uid"]:
+            sql = f"SELECT user FROM users WHERE {field} = ?"
+        else:
+            sql = f"SELECT user FROM user_{field} WHERE value = ?"
+        return [row[0] for row in self.db().execute(sql, (value, ))]
+
+
+user_store = None
+
+
+def store():
+    """ the backend in the policy, 'files' or 'sqlite' """
+    global user_store
+    if user_store is None:
+        if policy.get("user_store", "files") == "sqlite":
+            user_store = SqliteStore(policy.USER_DB)
+        else:
+            user_store = FileStore(
+                cache_size=policy.get("user_cache_size", USER_CACHE_SIZE))
+    return user_store
+
+
+def load(user, with_events=False):
+    """ load a user, the events log is only read if {with_events} """
+    ok, js = store().load(user)
+    if ok:
+        old_events = js.pop("events", [])
+        if with_events:
+            js["events"] = old_events + load_events(user)
+    return ok, js
+
+
+def update(user, data, with_events=False):
+    """ merge {data} into the user, None deletes the user & events are appended to its log """
+    if data is None:
+        remove_events(user)
+        return store().update(user, None)
+
+    data, events = split_events(data)
+    ok, js = store().update(user, data)
+    if ok:
+        append_events(user, js.pop("events", []) + events)
+        if with_events:
+            js["events"] = load_events(user)
+    return ok, js
+
+
+def create(user, data):
+    data, events = split_events(data)
+    ok, reply = store().create(user, data)
+    if ok:
+        remove_events(user)
+        append_events(user, events)
+    return ok, reply
+
+
+def exists(user):
+    return store().exists(user)
+
+
+def remove(user):
+    remove_events(user)
+    return store().remove(user)
+
+
+def all_users():
+    return store().all_users()
+
+
+def load_all(skip=None, known=None):
+    """ every user, except {skip}, without their events or utf8 names, as {user: (stamp, record)}.
+        Users in {known}, from an earlier call, are only re-read if they have changed """
+    # JSON parsing holds the GIL, so threads were slower than one worker when measured
+    workers = policy.get("load_workers", None) or LOAD_WORKERS
+    all_users = store().load_all(workers,
+                                 concurrent.futures.ThreadPoolExecutor, known)
+    all_users.pop(skip, None)
+    return all_users
+
+
+def find_users(field, value):
+    """ names of the users whose {field} (one of INDEXED_FIELDS) has {value} """
+    if field not in INDEXED_FIELDS:
+        raise ValueError(f"Can't find users by '{field}'")
+    return store().find_users(field, value)
+
+
+def move_events():
+    """ move events still held in user records into their logs, returns the number moved """
+    count = 0
+    for user in all_users():
+        ok, js = store().load(user)
+        if ok and "events" in js:
+            update(user, {})
+            count += 1
+    return count
+
+
+def migrate(from_store, to_store):
+    """ copy every user from one backend to another, returns the number copied """
+    count = 0
+    for user in from_store.all_users():
+        ok, js = from_store.load(user)
+        if not ok:
+            continue
+        for item in ["user", "utf8"]:
+            js.pop(item, None)
+        to_store.remove(user)
+        to_store.create(user, js)
+        count += 1
+    return count
+
+
+def bench_user(num):
+    now = misc.now()
+    return {
+        "mx": f"mx{num}",
+        "password": "x",
+        "created_dt": now,
+        "amended_dt": now,
+        "last_login_dt": now,
+        "email": f"person{num}@example.com",
+        "uid": 1000 + num,
+        "events": [{
+            "when_dt": now,
+            "desc": "Account first registered"
+        }],
+        "identities": [f"me@dom{num}.example"],
+        "domains": {
+            f"user{num}": True,
+            f"dom{num}.example": True
+        }
+    }
+
+
+def bench_store(this_store, count, probes=1000):
+    results = {}
+    start = time.perf_counter()
+    for num in range(0, count):
+        this_store.create(f"user{num}", bench_user(num))
+    results["create"] = time.perf_counter() - start
+
+    sample = random.sample(range(0, count), min(probes, count))
+    start = time.perf_counter()
+    for num in sample:
+        this_store.load(f"user{num}")
+    results[f"load {len(sample)}"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for num in sample:
+        this_store.update(f"user{num}", {"last_login_dt": misc.now()})
+    results[f"update {len(sample)}"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    users = this_store.all_users()
+    results[f"list {len(users)}"] = time.perf_counter() - start
+
+    for field, value in [("email", f"person{sample[0]}@example.com"),
+                         ("uid", 1000 + sample[0]),
+                         ("domain", f"dom{sample[0]}.example")]:
+        start = time.perf_counter()
+        if this_store.find_users(field, value) != [f"user{sample[0]}"]:
+            print(f"ERROR: find by {field} failed")
+        results[f"find {field}"] = time.perf_counter() - start
+
+    return results
+
+
+def bench_cache(loads=10000):
+    """ time repeated loads of one user, as each webui request does, with & without the cache """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for cache_size in [0, USER_CACHE_SIZE]:
+            this_store = FileStore(tmpdir, cache_size)
+            js = bench_user(1)
+            js["events"] = js["events"] * 50
+            this_store.create("user1", js)
+            start = time.perf_counter()
+            for __ in range(0, loads):
+                this_store.load("user1")
+            taken = time.perf_counter() - start
+            print(f"{loads} loads, cache {cache_size} -> {taken:.3f}s, " +
+                  f"{taken / loads * 1000000:.1f}us each" +
+                  ("" if this_store.cache is
+                   None else f", {this_store.cache.stats}"))
+            this_store.update("user1", {"last_login_dt": misc.now()})
+            if this_store.load("user1")[1].get("last_login_dt") is None:
+                print("ERROR: stale user served after update")
+            this_store.remove("user1")
+
+
+def bench_events(history=500, adds=1000):
+    """ time adding events & loading a user with {history} events, held in the record vs in the log """
+    global user_store
+    save_user_dir, save_store = policy.USER_DIR, user_store
+    with tempfile.TemporaryDirectory() as tmpdir:
+        policy.USER_DIR = tmpdir
+        this_store = user_store = FileStore(tmpdir, 0)
+        user_file = this_store.file_name("user1", with_make_dir=True)
+        for how in ["record", "log"]:
+            js = bench_user(1)
+            js["events"] = js["events"] * history
+            remove("user1")
+            if how == "record":
+                this_store.create("user1", js)
+            else:
+                create("user1", js)
+
+            start = time.perf_counter()
+            for __ in range(0, adds):
+                if how == "record":
+                    with open(user_file, "r") as fd:
+                        js = json.load(fd)
+                    js["events"].append({"when_dt": misc.now(), "desc": "x"})
+                    with open(user_file + ".new", "w") as fd:
+                        json.dump(js, fd, indent=2)
+                    os.replace(user_file + ".new", user_file)
                 else:
-                    if item == "events":
-                        if isinstance(this_data, dict):
-                            if "when_dt" not in this_data:
-                                this_data["when_dt"] = misc.now()
-                            js[item].append(this_data)
-                        elif isinstance(this_data, list):
-                            for each_event in this_data:
-                                if "when_dt" not in each_event:
-                                    each_event["when_dt"] = misc.now()
-                                js[item].append(each_event)
-                    else:
-                        js[item] = this_data
-
-        js["amended_dt"] = misc.now()
-        new_file = user_file + ".new"
-        with open(new_file, "w") as fd:
-            json.dump(js, fd, indent=2)
-        os.replace(new_file, user_file)
-
-        js["user"] = user
-        if not with_events and "events" in js:
-            del js["events"]
-
-        return True, js
+                    append_events("user1", [{"desc": "x"}])
+            added = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for __ in range(0, adds):
+                load("user1")
+            loaded = time.perf_counter() - start
+            print(f"events in {how} -> add {added / adds * 1000000:.1f}us, " +
+                  f"load {loaded / adds * 1000000:.1f}us, " +
+                  f"file {os.path.getsize(user_file)} bytes")
+    policy.USER_DIR, user_store = save_user_dir, save_store
+
+
+def same_bucket_users(count):
+    """ {count} user names that all hash to the same directory """
+    users = ["user0"]
+    num = 0
+    while len(users) < count:
+        num += 1
+        if calc_hash(f"user{num}") == calc_hash(users[0]):
+            users.append(f"user{num}")
+    return users
+
+
+def contention_writer(how, path, user, writer, updates):
+    this_store = SqliteStore(path) if how == "sqlite" else FileStore(path, 0)
+    if how == "bucket lock":
+        user_file = this_store.file_name(user)
+        lock_file = os.path.join(os.path.dirname(user_file), ".lock")
+    for num in range(0, updates):
+        data = {f"w{writer}": num}
+        if how == "bucket lock":
+            # as updates used to be, one lock per directory, held throughout
+            with filelock.FileLock(lock_file):
+                with open(user_file, "r") as fd:
+                    js = json.load(fd)
+                apply_update(js, data)
+                os.replace(write_new(user_file, js), user_file)
+        else:
+            this_store.update(user, data)
+
+
+def bench_contention(writers=8, updates=200):
+    """ {writers} processes updating users in the same hash bucket, then all the same user """
+    users = same_bucket_users(writers)
+    for how in ["bucket lock", "per-user", "sqlite"]:
+        for shared in [False, True]:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir,
+                                    "users.db") if how == "sqlite" else tmpdir
+                this_store = SqliteStore(
+                    path) if how == "sqlite" else FileStore(path, 0)
+                for user in users:
+                    this_store.create(user, bench_user(1))
+                procs = [
+                    multiprocessing.Process(
+                        target=contention_writer,
+                        args=(how, path, users[0] if shared else users[num],
+                              num, updates)) for num in range(0, writers)
+                ]
+                start = time.perf_counter()
+                for proc in procs:
+                    proc.start()
+                for proc in procs:
+                    proc.join()
+                taken = time.perf_counter() - start
+
+                ok, js = this_store.load(users[0])
+                want = writers if shared else 1
+                got = len([
+                    num for num in range(0, writers)
+                    if js.get(f"w{num}", None) == updates - 1
+                ])
+                print(
+                    f"{how}, {writers} writers, " +
+                    f"{'one user' if shared else 'own users'} -> " +
+                    f"{taken:.3f}s, {writers * updates / taken:.0f} updates/s"
+                    +
+                    ("" if got ==
+                     want else f", ERROR: {want - got} writers' updates lost"))
+
+
+def bench_startup(count=50000, workers=8):
+    """ time loading every one of {count} users, as the DOMS runner does at start up """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        this_store = FileStore(tmpdir, 0)
+        for num in range(0, count):
+            this_store.create(f"user{num}", bench_user(num))
+
+        start = time.perf_counter()
+        found = subprocess.run(
+            ["find", tmpdir, "-type", "f", "-name", "*.json"],
+            capture_output=True)
+        loaded = {}
+        for file in found.stdout.decode("utf-8").strip().split():
+            user = file.split("/")[-1][:-5]
+            loaded[user] = this_store.load(user)[1]
+        print(f"{count} users, find & load each -> " +
+              f"{time.perf_counter() - start:.3f}s, {len(loaded)} loaded")
+
+        for desc, this_workers, pool_type in [
+            ("scandir", 1, None),
+            (f"scandir, {workers} threads", workers,
+             concurrent.futures.ThreadPoolExecutor),
+            (f"scandir, {workers} processes", workers,
+             concurrent.futures.ProcessPoolExecutor)
+        ]:
+            start = time.perf_counter()
+            loaded = this_store.load_all(this_workers, pool_type)
+            print(f"{count} users, {desc} -> " +
+                  f"{time.perf_counter() - start:.3f}s, {len(loaded)} loaded")
+
+
+def run_bench(counts):
+    for count in counts:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "users"))
+            file_store = FileStore(os.path.join(tmpdir, "users"))
+            sqlite_store = SqliteStore(os.path.join(tmpdir, "users.db"))
+            for name, this_store in [("files", file_store),
+                                     ("sqlite", sqlite_store)]:
+                results = bench_store(this_store, count)
+                print(f"{count} users, {name} -> " +
+                      ", ".join(f"{desc} {taken:.3f}s"
+                                for desc, taken in results.items()))
+
+            start = time.perf_counter()
+            migrated = migrate(file_store,
+                               SqliteStore(os.path.join(tmpdir, "copy.db")))
+            print(f"{count} users, migrate {migrated} -> " +
+                  f"{time.perf_counter() - start:.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='User store')
+    parser.add_argument("-u", "--user", help="Load a user")
+    parser.add_argument("-M",
+                        "--migrate",
+                        default=False,
+                        help="Copy all users from the files into SQLite",
+                        action="store_true")
+    parser.add_argument("-B",
+                        "--bench",
+                        default=False,
+                        help="Benchmark the files & SQLite backends",
+                        action="store_true")
+    parser.add_argument("-C",
+                        "--cache",
+                        default=False,
+                        help="Benchmark the file store's load cache",
+                        action="store_true")
+    parser.add_argument("-E",
+                        "--events",
+                        default=False,
+                        help="Move events held in user records to their logs",
+                        action="store_true")
+    parser.add_argument("-b",
+                        "--bench-events",
+                        default=False,
+                        help="Benchmark events in the record vs in a log",
+                        action="store_true")
+    parser.add_argument("-w",
+                        "--writers",
+                        type=int,
+                        help="Benchmark this many concurrent writers")
+    parser.add_argument("-L",
+                        "--load-all",
+                        type=int,
+                        help="Benchmark loading all of this many users")
+    parser.add_argument("-n",
+                        "--counts",
+                        default="10000,100000",
+                        help="Number of users to benchmark with")
+    args = parser.parse_args()
+
+    if args.cache:
+        bench_cache()
+    elif args.load_all:
+        bench_startup(args.load_all)
+    elif args.writers:
+        bench_contention(args.writers)
+    elif args.bench_events:
+        bench_events()
+    elif args.events:
+        print("Moved events for", move_events(), "users")
+    elif args.bench:
+        run_bench([int(count) for count in args.counts.split(",")])
+    elif args.migrate:
+        print("Migrated", migrate(FileStore(), SqliteStore(policy.USER_DB)),
+              "users")
+        print("Set 'user_store' to 'sqlite' in the policy to use them")
+    elif args.user:
+        print(json.dumps(load(args.user, with_events=True), indent=2))
+    else:
+        parser.print_help(sys.stderr)
 
 
 if __name__ == "__main__":
-    print("INFO LOAD ->", load("anon.webmail"))
-    print("INFO UPDATE ->",
-          update("anon.webmail", {"events": {
-              "desc": "New Some event"
-          }}))
-    print("INFO LOAD ->", load("anon.webmail"))
-    # print("INFO ADD ->",
-    #       update("anon.webmail", {"temp": "value"}))
-    # print("INFO LOAD ->", load("anon.webmail"))
-    # print("INFO ADD ->",
-    #       update("anon.webmail", {"temp": None}))
-    # print("INFO LOAD ->", load("anon.webmail"))
-    # print("INFO LOAD ->", load("anon.webmail"))
+    main()
@@ -5,6 +5,7 @@
 import tempfile
 import time
 import os
+import fcntl
 import json
 import passlib.hash
 import secrets
@@ -107,6 +108,48 @@ def check_password(user, sent_data):
                              user_data["password"]), "Password match failed"
 
 
+def claim_recheck(user):
+    """ True if {user} can recheck now. A new marker is made exclusively, an old one is
+        checked & touched under a lock, so only one webui worker wins """
+    os.makedirs(policy.RECHECK_DIR, exist_ok=True)
+    marker = os.path.join(policy.RECHECK_DIR, user)
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        return True
+    except FileExistsError:
+        pass
+
+    try:
+        fd = os.open(marker, os.O_WRONLY)
+    except FileNotFoundError:
+        return claim_recheck(user)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if time.time() - os.fstat(fd).st_mtime < policy.get(
+                "recheck_min_interval", 60):
+            return False
+        os.utime(fd)
+        return True
+    finally:
+        os.close(fd)
+
+
+def recheck_domains(user):
+    """ ask the DOMS runner to check {user}'s domains now, at most once every {recheck_min_interval} secs """
+    if not claim_recheck(user):
+        return False, "Domains were checked recently, try again shortly"
+
+    executor.create_command("webui_recheck",
+                            "doms", {
+                                "verb": "recheck_user",
+                                "data": {
+                                    "user": user
+                                }
+                            },
+                            priority=executor.INTERACTIVE)
+    return True, None
+
+
 def logout(session_code, user, user_agent):
     ok, user_data = check_session(session_code, user_agent)
     if not ok or user_data is None:
@@ -140,14 +183,15 @@ def request_password_reset(user, sent_data):
     if validation.user_already_has_reset(user):
         return False, "Password reset request already exists"
 
-    executor.create_command(
-        "webui_password_request", "doms", {
-            "verb": "request_password_reset",
-            "data": {
-                "user": user,
-                "pin": sent_data["pin"]
-            }
-        })
+    executor.create_command("webui_password_request",
+                            "doms", {
+                                "verb": "request_password_reset",
+                                "data": {
+                                    "user": user,
+                                    "pin": sent_data["pin"]
+                                }
+                            },
+                            priority=executor.INTERACTIVE)
 
     return True, None
 
@@ -203,43 +247,48 @@ def register(sent_data, user_agent):
         }
     }
 
-    file = uconfig.user_file_name(user, True)
-    with open(file, "w+") as fd:
-        json.dump(user_data, fd, indent=2)
+    ok, reply = uconfig.create(user, user_data)
+    if not ok:
+        return False, reply
 
-    executor.create_command("new_user_added", "doms", {
-        "verb": "new_user_added",
-        "data": {
-            "user": user
-        }
-    })
+    executor.create_command("new_user_added",
+                            "doms", {
+                                "verb": "new_user_added",
+                                "data": {
+                                    "user": user
+                                }
+                            },
+                            priority=executor.INTERACTIVE)
     return create_session_file(user, user_data, user_agent)
 
 
 def close_account(user):
-    file = uconfig.user_file_name(user)
-    log.debug(f"close_account: {user} - {file}")
-    if not os.path.isfile(file):
+    log.debug(f"close_account: {user}")
+    if not uconfig.exists(user):
         return False, "User not found"
 
-    os.remove(file)
-    executor.create_command("webui_account_closed", "doms", {
-        "verb": "account_closed",
-        "data": {
-            "user": user
-        }
-    })
+    uconfig.remove(user)
+    executor.create_command("webui_account_closed",
+                            "doms", {
+                                "verb": "account_closed",
+                                "data": {
+                                    "user": user
+                                }
+                            },
+                            priority=executor.INTERACTIVE)
     return True, None
 
 
 def password_new(user, password):
     uconfig.update(user, {"password": encrypt(password)})
-    executor.create_command("webui_password_changed", "doms", {
-        "verb": "password_changed",
-        "data": {
-            "user": user
-        }
-    })
+    executor.create_command("webui_password_changed",
+                            "doms", {
+                                "verb": "password_changed",
+                                "data": {
+                                    "user": user
+                                }
+                            },
+                            priority=executor.INTERACTIVE)
     return True
 
 
@@ -294,7 +343,8 @@ def reset_user_password(sent_data):
             "events": {
                 "desc": "Password has been reset"
             },
-            "password": encrypt(sent_data["password"])
+            "password": encrypt(sent_data["password"]),
+            "password_reset": None
         })
     sendmail.post("password_is_reset", {"user": user_data})
     return True, None
@@ -5,14 +5,13 @@
 import os
 import re
 import sys
-import glob
-import json
 
 import misc
 import resolv
 import uconfig
 import fileloader
 import icann_tlds
+import tld_index
 from policy import this_policy as policy
 
 IS_HOST = r'^(\*\.|)([\_a-z0-9]([-a-z-0-9]{0,61}[a-z0-9]){0,1}\.)+[a-z0-9]([-a-z0-9]{0,61}[a-z0-9]){0,1}[.]?$'
@@ -40,12 +39,10 @@ def user_already_has_reset(user):
     if not is_valid_account(user):
         return True
 
-    for file in glob.glob(os.path.join(policy.RESET_CODES, '*')):
-        with open(file, "r") as fd:
-            js = json.load(fd)
-            if js.get("user", "#") == user:
-                return True
-    return False
+    ok, user_data = uconfig.load(user, with_events=False)
+    if not ok or (code := user_data.get("password_reset", None)) is None:
+        return False
+    return os.path.isfile(os.path.join(policy.RESET_CODES, code))
 
 
 def is_valid_email(email):
@@ -160,8 +157,7 @@ def pre_check_user(user, is_new):
     if tld in icann_tlds.ICANN_TLDS and not policy.get("allow_icann_domains"):
         return False, "ICANN domains are not allowed"
 
-    file = uconfig.user_file_name(user, True)
-    already_in_use = (user in used_domains.data()) or (os.path.isfile(file))
+    already_in_use = (user in used_domains.data()) or uconfig.exists(user)
 
     if is_new and already_in_use:
         return False, "Domain is already registered"
@@ -183,20 +179,22 @@ def web_valid_new_account(user):
         return ok, reply
 
     tld = reply
-    res = resolv.Resolver()
-    flags = 0 if policy.get(
-        "dns_supports_authoritative") else resolv.DNS_FLAGS["RD"]
-    if (tld_dns := res.resolv(tld, "px", flags=flags)) is None:
-        return False, "TLD Failed to resolve"
-
-    if tld_dns.get("Status", 3) != 0:
-        return False, "TLD does not exist"
+    res = resolv.get_shared_resolver(policy.get("dns_cache_size", 10000),
+                                     policy.DNS_CACHE_FILE)
+    # MX, not some other type, so the answer is already cached for the DOMS runner's first check
+    if not tld_index.this_index.exists(tld):
+        flags = 0 if policy.get(
+            "dns_supports_authoritative") else resolv.DNS_FLAGS["RD"]
+        if (tld_dns := res.resolv_mx(tld, flags=flags)) is None:
+            return False, "TLD Failed to resolve"
+
+        if tld_dns.rcode != 0:
+            return False, "TLD does not exist"
 
     if tld == user:
         return True, None
 
-    if (user_dns := res.resolv(user, "px")) is None or user_dns.get(
-            "Status", 3) != 0:
+    if (user_dns := res.resolv_mx(user)) is None or user_dns.rcode != 0:
         return False, "Domain does not exist"
 
     return True, None